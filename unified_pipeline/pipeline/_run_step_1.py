@@ -4,7 +4,7 @@ Used to call pipeline_step_1.py from pipeline.py
 
 import sys
 from pathlib import Path
-from pipeline_step_1 import run_preprocessing, analyze_new
+from pipeline_step_1 import run_preprocessing, analyze_new, run_pipelined, PIPELINED_STEP_1
 import logging
 logger = logging.getLogger(__name__)
 
@@ -13,13 +13,18 @@ if __name__=="__main__":
         videos = sys.argv[1]
         logger.info(f"Using video path {videos}.")
 
-        logger.info("Starting DLC Analysis.")
-        analyze_new(videos)
-        logger.info("Finished DLC Analysis.")
+        if PIPELINED_STEP_1:
+            logger.info("Starting DLC Analysis, DLC post-processing and Anipose pre-processing as a pipeline.")
+            run_pipelined(videos)
+            logger.info("Finished DLC Analysis, DLC post-processing and Anipose pre-processing.")
+        else:
+            logger.info("Starting DLC Analysis.")
+            analyze_new(videos)
+            logger.info("Finished DLC Analysis.")
 
-        logger.info("Starting DLC post-processing, Anipose pre-processing.")
-        run_preprocessing(videos)
-        logger.info("Finished DLC post-processing, Anipose pre-processing.")
+            logger.info("Starting DLC post-processing, Anipose pre-processing.")
+            run_preprocessing(videos)
+            logger.info("Finished DLC post-processing, Anipose pre-processing.")
 
         logger.info("Finished running pipeline step 1/2.")
     else:
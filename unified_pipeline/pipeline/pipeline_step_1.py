@@ -20,6 +20,7 @@ logger = logging.getLogger(__name__)
 # logger.setLevel(logger.INFO)
 # logger.debug("Logging works :)")
 
+import os
 import pandas as pd
 import shutil
 from pathlib import Path
@@ -34,78 +35,34 @@ VIDEOS_PATH = Path(settings.videos_path)
 COMMON_FILES = Path(settings.common_files)
 SAVE_FINAL_CSV: bool = settings.save_final_csv
 SKIP_PREPROCESSING_FUNCTIONS: bool = settings.skip_preprocessing_functions
-
-
-from src.calibration import get_calibration_type, get_anipose_calibration_files
-from src.clean import fix_point, replace_likelihood, remove_cols
-from src.dlc import analyze_new
-from src.file_tools import load_config, load_csv_as_df, get_genotype
+HDF_OPTIONS: dict = dict(settings.get("hdf", {}))
+PREPROCESSING_WORKERS: int = settings.get("preprocessing_workers", 1)
+STREAM_PREPROCESSING: bool = settings.get("stream_preprocessing", False)
+FILE_PLACEMENT: str = settings.get("file_placement", "copy")
+COPY_WORKERS: int = settings.get("copy_workers", 4)
+PIPELINED_STEP_1: bool = settings.get("pipelined_step_1", False)
+DLC_LEDGER: str = settings.get("dlc_ledger", "")
+
+
+import src.fs_index as fs_index
+from src.calibration import get_calibration_type, get_anipose_calibration_files, close_staging
+from src.dlc import (
+    ModelRegistry,
+    analyze_new,
+    analyze_pipelined,
+    find_filtered_output,
+    find_pending_videos,
+)
+from src.file_tools import load_config, find_dlc_outputs, place_file
 from src.hdf import df2hdf
+from src.ledger import JobLedger
+from src.preprocess import RESULT_CACHE, clean_all, clean_and_write, clean_dfs, parallel_map
+from src.anipose_files import CONTEXTS, index_dlc_outputs, plan_anipose_files, execute_plan
 
 import pickle
 
 pickle.HIGHEST_PROTOCOL = 4  # Important for compatibility
 
-
-def clean_dfs(p_csv: Path) -> pd.DataFrame:
-    """Run any functions that clean the raw data. Any new cleaning steps can be added here.
-
-    Parameters
-    ----------
-    p_csv : Path
-        path to a CSV file that will be processed.
-
-    Returns
-    -------
-    pd.DataFrame
-        Processed CSV as a DF
-    """
-    logger.info(f"Processing {p_csv.name}")
-    csv_df = load_csv_as_df(
-        p_csv
-    )  # Flat CSV (req'd for current method of preprocessing)
-
-    if SKIP_PREPROCESSING_FUNCTIONS:
-        # For debugging purposes, if you do not want to rerun these functions each time (to speed up this step), you can just skip over them
-        return csv_df
-
-    # Fix points
-    logger.info(" Running `Fix points` preprocessing...")
-    # Columns which will have points fixed, add/remove to change which cols processed
-    col_names = [
-        "R-F-ThC",
-        "R-M-ThC",
-        "R-H-ThC",
-        "L-F-ThC",
-        "L-M-ThC",
-        "L-H-ThC",
-        "R-WH",
-        "L-WH",
-        "Notum",
-    ]
-    n = 0  # Values will be replaced with the nth entry. To replace with the mean, use n=0
-    csv_df = fix_point(csv_df, col_names, n)
-
-    # Remove cols
-    logger.info("Running `Remove cols` preprocessing...")
-    camName = p_csv.name[0]  # Camera letter name
-    start = ""
-    # TODO: remove end from here and function, since unused
-    if camName == "B":
-        logger.info("camName `B`, removing cols starting with `L-`")
-        start = "L-"  # Remove col if start of name matches string
-    if camName == "E":
-        logger.info("camName `E`, removing cols starting with `R-`")
-        start = "R-"  # Remove col if start of name matches string
-    if start:
-        csv_df = remove_cols(csv_df, start)
-
-    # Repalce 'likelihood' column values with 1.0
-    csv_df = replace_likelihood(csv_df)
-
-    return csv_df  # without file write
-
-
 def traverse_dirs(
     directory_structure: dict, parent_dir: Path, root: Path, path: Path = Path("")
 ) -> None:
@@ -158,13 +115,13 @@ def traverse_dirs(
                     filepath = path / new_name
                     if not filepath.exists():
                         logger.info(f"Copying file {original_filepath} to {filepath}")
-                        shutil.copy(original_filepath, filepath)
+                        place_file(original_filepath, filepath, FILE_PLACEMENT)
                 # If just path, then the file name will be the same as original
                 elif isinstance(file, Path):
                     filepath = path / file.name
                     if not filepath.exists():
                         logger.info(f"Copying file {file} to {filepath}")
-                        shutil.copy(file, filepath)
+                        place_file(file, filepath, FILE_PLACEMENT)
                 else:
                     logger.warning(
                         f"Skipping {file}, all files in `filescp` should be paths"
@@ -177,7 +134,7 @@ def traverse_dirs(
                 current_nx_dir = path.parent.name  # Nx dir currently being traversed
                 # Check that parent directory and Nx folder are the same
                 if parent_dir in csv_path.parents and csv_nx == current_nx_dir:
-                    df2hdf(df, csv_path, path, root)
+                    df2hdf(df, csv_path, path, root, **HDF_OPTIONS)
         elif (
             parent == "filesmk" and child
         ):  # Create the file if only the file name provided
@@ -198,9 +155,13 @@ def gen_anipose_files(
     p_gcam_dummy: Path,
     root: Path,
     structure: dict = {},
-) -> None:
+    anipose_dir: Path = None,
+) -> list:
     """Generate the necessary anipose file structure given a parent path and a file structure
 
+    By default, the DLC outputs are indexed by fly, context (Ball, SS) and camera and each cleaned DF is only
+    written to the `pose-2d` folder of its own fly and context (see `src.anipose_files`).
+
     Parameters
     ----------
     parent_dir : Path
@@ -212,7 +173,8 @@ def gen_anipose_files(
     p_calibration_timeline: Path
         File path to calibration timeline config file
     preprocessed_dfs: list
-        List of tuples in the form (processed_df, csv_path)
+        List of tuples in the form (processed_df, csv_path). If processed_df is None, the HDF file is not
+        written but its path is returned as a pending `convert` operation
     p_gcam_dummy: Path
         filepath to the gcam dummy file
     structure : dict, optional
@@ -222,6 +184,13 @@ def gen_anipose_files(
              1. `filesmv` - this key takes a list of Path objects and moves the files from the path provided to the new path specified in the dict structure
              2. `filescp` - this key takes a list of Path objects and copies the files from the path provided to the new path specified in the dict structure
              3. `filesmk` - this key takes a list of strings that specify the name and extension of a new file that will be created at the path specified in the dict structure
+    anipose_dir : Path, optional
+        Folder for the default structure instead of `parent_dir / "anipose"`, see `src.anipose_files.plan_anipose_files`
+
+    Returns
+    -------
+    list
+        The executed file operations (`src.anipose_files.FileOp`), None if the generation failed
     """
 
     # Get anipose calib files based on configs set
@@ -246,114 +215,37 @@ def gen_anipose_files(
         logger.error("Calibration files not found")
         return
 
-    # Generate `project` folder structure for anipose
-    ball_project = {}
-    genotype = ""
-    logger.info(f"Generating `ball_` folder structure...")
-    for folder in parent_dir.glob("N*"):  # find all fly folders (N1-Nx)
-        logger.info(f"Searching {folder.name} directory")
-
-        ball_folder = parent_dir / folder / "Ball"
-
-        if not ball_folder.exists():
-            logger.error(f"Ball folder {ball_folder} does not exist.")
-            continue
-        else:
-            logger.info(f"Found Ball folder: {ball_folder}")
-            ball_file = next(ball_folder.glob("*.csv"))
-            if ball_file:
-                genotype = get_genotype(ball_file, root)
-                print(f"Genotype for {folder.name} is {genotype}")
-            else:
-                logger.error(f"Could not get genotype for {folder}.")
-                logger.warning(f"Skipping this Nx directory!")
-
-        # Create the gcam dummy file name by filling in the genotype and fly number
-        try:
-            gcam = (p_gcam_dummy, f"{genotype}-G.h5")
-        except:
-            gcam = (p_gcam_dummy, f"{genotype}-G.h5")
-        # Structure for the anipose `project` folder # ball_folder.name
-        ball_project[ball_folder.parent.name] = {
-            "pose-2d": {
-                "filescv": preprocessed_dfs,  # will convert the DFs to HDF
-                "filescp": [gcam],  # will copy the gcam file
-            },
-            "videos-raw": {},
-        }
-
-    SS_project = {}
-    genotype = ""
-    logger.info(f"Generating `SS_` folder structure...")
-    for folder in parent_dir.glob("N*"):  # find all fly folders (N1-Nx)
-        logger.info(f"Searching {folder.name} directory")
-
-        SS_folder = parent_dir / folder / "SS"
-
-        if not SS_folder.exists():
-            logger.error(f"Ball folder {SS_folder} does not exist.")
-            continue
-        else:
-            logger.info(f"Found SS folder: {SS_folder}")
-            SS_file = next(SS_folder.glob("*.csv"))
-            if SS_file:
-                genotype = get_genotype(SS_file, root)
-                print(f"Genotype for {folder.name} is {genotype}")
-            else:
-                logger.error(f"Could not get genotype for {folder}.")
-                logger.warning(f"Skipping this Nx directory!")
-
-        # Create the gcam dummy file name by filling in the genotype and fly number
-        try:
-            gcam = (p_gcam_dummy, f"{genotype}-G.h5")
-        except:
-            gcam = (p_gcam_dummy, f"{genotype}-G.h5")
-        # Structure for the anipose `project` folder # ball_folder.name
-        SS_project[SS_folder.parent.name] = {
-            "pose-2d": {
-                "filescv": preprocessed_dfs,  # will convert the DFs to HDF
-                "filescp": [gcam],  # will copy the gcam file
-            },
-            "videos-raw": {},
-        }
-
-    # Get network set name
+    # Get network set names
     cfg = load_config(p_network_cfg)
+    network_set_names = {context: cfg[context]["name"] for context in CONTEXTS}
+    logger.info(f"Using network set names {network_set_names}")
+
+    if structure:
+        logger.info("Using custom anipose file structure")
+        traverse_dirs(structure, parent_dir, root, parent_dir)
+        return True
+
+    # Index the DLC outputs of this experiment by fly, context and camera
+    flies = index_dlc_outputs(preprocessed_dfs).get(parent_dir, {})
+    if not flies:
+        logger.error(f"No DLC outputs found for {parent_dir}")
+        return
 
-    ball_network_set_name = cfg["Ball"]["name"]  # network set for ball
-    SS_network_set_name = cfg["SS"]["name"]  # network set for ball
-
-    logger.info(f"Using network set name {ball_network_set_name}")
-    if not structure:
-        logger.info("Using default anipose file structure")
-        # Default file structure
-        structure = {
-            "anipose": {
-                "Ball": {
-                    f"{ball_network_set_name}": {
-                        # will copy calibration files
-                        "calibration": {"filescp": calibration_files},
-                        "project": ball_project,  # N1-Nx
-                        # Will copy the anipose config as `config.toml`
-                        "filescp": [(p_anipose_config, "config.toml")],
-                    },
-                },
-                "SS": {
-                    f"{SS_network_set_name}": {
-                        # will copy calibration files
-                        "calibration": {"filescp": calibration_files},
-                        "project": SS_project,  # N1-Nx
-                        # Will copy the anipose config as `config.toml`
-                        "filescp": [(p_anipose_config, "config.toml")],
-                    },
-                },
-            }
-        }
-
-    traverse_dirs(structure, parent_dir, root, parent_dir)
+    logger.info("Using default anipose file structure")
+    plan = plan_anipose_files(
+        parent_dir,
+        flies,
+        network_set_names,
+        calibration_files,
+        p_anipose_config,
+        p_gcam_dummy,
+        root,
+        anipose_dir,
+    )
+    execute_plan(plan, HDF_OPTIONS, FILE_PLACEMENT, COPY_WORKERS)
 
     # Ran succesfully
-    return True
+    return plan
 
 
 def run_preprocessing(
@@ -363,10 +255,13 @@ def run_preprocessing(
     p_calibration_target=COMMON_FILES / Path("calibration_target.yml"),
     p_calibration_timeline=COMMON_FILES / Path("calibration_timeline.yml"),
     p_gcam_dummy=COMMON_FILES / Path("GenotypeFly-G.h5"),
+    workers: int = PREPROCESSING_WORKERS,
+    stream: bool = STREAM_PREPROCESSING,
 ):
     """Runs preprocessing on all CSV files generated by DLC in provided path. This function will find ALL CSV files matching the pattern *_filtered.csv
+    If DLC also wrote the matching *_filtered.h5 file, the h5 file is read instead of the CSV, which is much faster.
     Thus, for any DLC generated output, the corresponding Anipose preprocessing will be run (any preprocessing on the data as well as the Anipose folder structure)
-    The subfunction, traverse_dirs, that generates the file structure will check for duplicate dirs, so if an Anipose folder already exists, generation will be skipped.
+    If an Anipose folder already exists for an experiment, its outputs are neither cleaned nor generated again.
 
     Parameters
     ----------
@@ -383,6 +278,12 @@ def run_preprocessing(
     p_gcam_dummy : Path, optional
         Path to the h5 file used as dummy for camera G,
         by default Path('common_files/GenotypeFly-G.h5')
+    workers : int, optional
+        Number of processes used to clean the CSVs, 1 runs serially and 0 uses all CPUs,
+        by default `preprocessing_workers` from the settings
+    stream : bool, optional
+        If True, each cleaned CSV is written to its `pose-2d` folder right away instead of keeping
+        all of them in memory until the anipose files are generated, by default `stream_preprocessing` from the settings
     """
 
     # find all the CSVs that DLC generated
@@ -395,10 +296,11 @@ def run_preprocessing(
                         Only enable if intended and typically for debugging purposes."
         )
 
-    processed_dirs = {}
-    for p_csv in videos.glob(
-        "**/*_filtered.csv"
-    ):  # get all filtered CSVs - both Ball and SS
+    # get all filtered DLC outputs - both Ball and SS, h5 if present, else CSV
+    fs_index.refresh(videos)  # pick up the outputs DLC wrote
+    p_csvs = []
+    skipped_dirs = set()
+    for p_csv in find_dlc_outputs(videos):
 
         # The directory holding all data for that particular experiment, i.e parent of nx dir
         parent_dir: Path = p_csv.parent.parent.parent
@@ -408,20 +310,44 @@ def run_preprocessing(
             )
             continue
 
+        # finished experiments are skipped before anything is cleaned
+        if (parent_dir / "anipose").exists():
+            if parent_dir not in skipped_dirs:
+                logger.warning(
+                    f"Skipping {parent_dir / 'anipose'} generation because it already exists. Please delete any old `anipose` directories to have them regenerated."
+                )
+                skipped_dirs.add(parent_dir)
+            continue
+
         # TODO: also check for cam name and model name
+        p_csvs.append(p_csv)
 
-        # Fix points, remove columns
-        csv_df = clean_dfs(p_csv)
+    # check that all the files exist
+    for p in [p_calibration_target, p_calibration_timeline, p_gcam_dummy]:
+        if not p.exists():
+            raise FileNotFoundError(f"{p} does not exist.")
 
-        if SAVE_FINAL_CSV:
-            # If config varialbe set, then save the preprocessed data to a CSV for examination
-            csv_name = p_csv.stem  # name of the csv without extension
-            preprocessed_name = p_csv + "_preprocessed"
-            preprocessed_csv_path = p_csv.with_name(preprocessed_name).with_suffix(
-                ".csv"
-            )
-            logger.info(f"Saving final preprocessed data to {preprocessed_csv_path}")
-            csv_df.to_csv(preprocessed_csv_path)
+    if stream:
+        stream_preprocessing(
+            p_csvs,
+            root,
+            p_networks,
+            p_calibration_target,
+            p_calibration_timeline,
+            p_gcam_dummy,
+            workers,
+        )
+        if RESULT_CACHE is not None:
+            RESULT_CACHE.evict()
+        close_staging()
+        fs_index.save()
+        print("Finished preprocessing...")
+        return
+
+    processed_dirs = {}
+    # Fix points, remove columns
+    for csv_df, p_csv in clean_all(p_csvs, workers):
+        parent_dir: Path = p_csv.parent.parent.parent
 
         processed_csv = (csv_df, p_csv)
 
@@ -433,11 +359,6 @@ def run_preprocessing(
             processed_dirs[parent_dir] = [processed_csv]
 
     # Generate anipose file structure
-    # check that all the files exist
-    for p in [p_calibration_target, p_calibration_timeline, p_gcam_dummy]:
-        if not p.exists():
-            raise FileNotFoundError(f"{p} does not exist.")
-
     logger.info("Generating anipose files...")
 
     for parent_dir, processed_csvs in processed_dirs.items():
@@ -459,4 +380,218 @@ def run_preprocessing(
         ):
             # TODO: gen_anipose_files needs to return somethng when it finishes (maybe directory where it was generated)
             logger.warning(f"Skipped anipose generation for {parent_dir}")
+
+    if RESULT_CACHE is not None:
+        RESULT_CACHE.evict()
+    close_staging()
+    fs_index.save()
     print("Finished preprocessing...")
+
+
+def stream_preprocessing(
+    p_csvs: list,
+    root: Path,
+    p_networks: Path,
+    p_calibration_target: Path,
+    p_calibration_timeline: Path,
+    p_gcam_dummy: Path,
+    workers: int = 1,
+) -> None:
+    """Clean the CSVs and write each one to its final `pose-2d` folder right away.
+
+    The anipose folder structure (without pose data) is generated first for every experiment,
+    then every CSV is cleaned, written to HDF and released, so at most one DF per worker is kept in memory.
+    Experiments that already have an `anipose` folder are skipped.
+
+    Each structure is built in an `anipose.partial` folder next to it, which is renamed to `anipose` once all
+    of its files are written. An `anipose.partial` folder left by a failed run is removed and generated again.
+
+    Parameters
+    ----------
+    p_csvs : list
+        Paths to the filtered CSVs generated by DLC
+    root : Path
+        Root directory
+    p_networks : Path
+        Path to network config files for DLC
+    p_calibration_target : Path
+        Path to calibration target config file
+    p_calibration_timeline : Path
+        Path to calibration timeline config file
+    p_gcam_dummy : Path
+        Path to the h5 file used as dummy for camera G
+    workers : int, optional
+        Number of worker processes, 1 runs serially and 0 uses all CPUs, by default 1
+    """
+    csvs_by_dir = {}
+    for p_csv in p_csvs:
+        csvs_by_dir.setdefault(p_csv.parent.parent.parent, []).append(p_csv)
+
+    logger.info("Generating anipose files...")
+    jobs = []
+    remaining = {}  # experiment -> number of HDF files still to write
+    for parent_dir, csvs in csvs_by_dir.items():
+
+        ANIPOSE_DIRECTORY: Path = parent_dir / "anipose"
+        if ANIPOSE_DIRECTORY.exists():
+            logger.warning(
+                f"Skipping {ANIPOSE_DIRECTORY} generation because it already exists. Please delete any old `anipose` directories to have them regenerated."
+            )
+            continue
+
+        p_partial = parent_dir / "anipose.partial"
+        if p_partial.exists():
+            logger.warning(f"Removing {p_partial} left by an unfinished run")
+            shutil.rmtree(p_partial)
+
+        # folder structure, calibration and config files, but no pose data yet
+        plan = gen_anipose_files(
+            parent_dir,
+            p_networks,
+            p_calibration_target,
+            p_calibration_timeline,
+            [(None, p_csv) for p_csv in csvs],
+            p_gcam_dummy,
+            root,
+            anipose_dir=p_partial,
+        )
+        if not plan:
+            logger.warning(f"Skipped anipose generation for {parent_dir}")
+            shutil.rmtree(p_partial, ignore_errors=True)
+            continue
+
+        # HDF files that still have to be written: (DLC output, HDF path)
+        ops = [op for op in plan if op.action == "convert" and op.data is None]
+        jobs += [(op.source, op.dest, parent_dir) for op in ops]
+        remaining[parent_dir] = len(ops)
+        if not ops:
+            os.replace(p_partial, ANIPOSE_DIRECTORY)
+
+    logger.info(f"Cleaning and writing {len(jobs)} CSVs...")
+    p_sources, p_hdfs, parent_dirs = zip(*jobs) if jobs else ((), (), ())
+    for p_csv, parent_dir in zip(parallel_map(clean_and_write, workers, p_sources, p_hdfs), parent_dirs):
+        logger.info(f"Finished {p_csv.name}")
+        remaining[parent_dir] -= 1
+        if remaining[parent_dir] == 0:
+            os.replace(parent_dir / "anipose.partial", parent_dir / "anipose")
+            logger.info(f"Finished {parent_dir / 'anipose'}")
+
+
+def run_pipelined(
+    videos: Path = VIDEOS_PATH,
+    root: Path = ROOT,
+    p_networks=COMMON_FILES / Path("DLC_network_sets.yml"),
+    p_calibration_target=COMMON_FILES / Path("calibration_target.yml"),
+    p_calibration_timeline=COMMON_FILES / Path("calibration_timeline.yml"),
+    p_gcam_dummy=COMMON_FILES / Path("GenotypeFly-G.h5"),
+    workers: int = PREPROCESSING_WORKERS,
+    analyzer=None,
+):
+    """Run DLC and the preprocessing of step 1 as one pipeline.
+
+    DLC inference, filtering and cleaning overlap (see `src.dlc.analyze_pipelined`): every DLC output is cleaned
+    as soon as it is filtered, and the anipose files of an experiment are generated as soon as all of its new
+    videos are done. Experiments without new videos are preprocessed at the end as in `run_preprocessing`.
+
+    Parameters
+    ----------
+    videos : Path
+        Path to folder containing videos (doesn't have to be direct parent)
+    root : Path
+        Root directory
+    p_networks : Path
+        Path to network config files for DLC
+    p_calibration_target : Path, optional
+        Path to the YML file which defines which folders require board- and fly-based calibrations
+    p_calibration_timeline : Path, optional
+        Path to the YML file which defines which calibration movie to use for which time range
+    p_gcam_dummy : Path, optional
+        Path to the h5 file used as dummy for camera G
+    workers : int, optional
+        Number of processes used to clean the DLC outputs, 1 runs serially and 0 uses all CPUs,
+        by default `preprocessing_workers` from the settings
+    analyzer : module, optional
+        Stand-in for `deeplabcut`, see `src.dlc.analyze_pipelined`, by default DLC is used
+    """
+    videos = Path(videos)
+    for p in [p_calibration_target, p_calibration_timeline, p_gcam_dummy]:
+        if not p.exists():
+            raise FileNotFoundError(f"{p} does not exist.")
+
+    registry = ModelRegistry()
+    ledger = JobLedger(DLC_LEDGER) if DLC_LEDGER else None
+    groups = find_pending_videos(videos, load_config(p_networks), registry, ledger)
+
+    # number of new videos per experiment (parent of the Nx dir) that are not filtered yet
+    remaining = {}
+    for video_files in groups.values():
+        for video in video_files:
+            parent_dir = video.parent.parent.parent
+            remaining[parent_dir] = remaining.get(parent_dir, 0) + 1
+    cleaned = {}
+
+    def generate(parent_dir: Path) -> None:
+        if (parent_dir / "anipose").exists():
+            logger.warning(
+                f"Skipping {parent_dir / 'anipose'} generation because it already exists. Please delete any old `anipose` directories to have them regenerated."
+            )
+            return
+        processed = cleaned.pop(parent_dir, [])
+        # outputs of videos that were analyzed in an earlier run
+        done = {p_csv for _, p_csv in processed}
+        fs_index.refresh(parent_dir)
+        others = [p for p in find_dlc_outputs(parent_dir) if p not in done]
+        processed += list(clean_all(others, workers))
+
+        logger.info(f"Generating anipose files for {parent_dir}...")
+        if not gen_anipose_files(
+            parent_dir,
+            p_networks,
+            p_calibration_target,
+            p_calibration_timeline,
+            processed,
+            p_gcam_dummy,
+            root,
+        ):
+            logger.warning(f"Skipped anipose generation for {parent_dir}")
+
+    def on_filtered(model, video_files: list) -> None:
+        outputs = []
+        for video in video_files:
+            p_output = find_filtered_output(video, model)
+            if p_output is None:
+                logger.error(f"No filtered DLC output found for {video}")
+            else:
+                outputs.append(p_output)
+
+        for csv_df, p_csv in clean_all(outputs, workers):
+            cleaned.setdefault(p_csv.parent.parent.parent, []).append((csv_df, p_csv))
+
+        for video in video_files:
+            parent_dir = video.parent.parent.parent
+            remaining[parent_dir] -= 1
+            if remaining[parent_dir] == 0:
+                generate(parent_dir)
+
+    analyze_pipelined(
+        videos,
+        p_networks,
+        on_filtered,
+        registry=registry,
+        ledger=ledger,
+        groups=groups,
+        **({"analyzer": analyzer} if analyzer is not None else {}),
+    )
+    if ledger is not None:
+        ledger.close()
+
+    # experiments without new videos, the generated ones are skipped
+    run_preprocessing(
+        videos,
+        root,
+        p_networks,
+        p_calibration_target,
+        p_calibration_timeline,
+        p_gcam_dummy,
+        workers,
+    )
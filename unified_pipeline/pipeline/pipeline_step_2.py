@@ -27,6 +27,7 @@ from config import settings
 VIDEOS_PATH = Path(settings.videos_path)
 
 from src.file_tools import find_nx_dirs
+import src.fs_index as fs_index
 from src.calibration import get_calibration_type
 
 
@@ -61,6 +62,7 @@ def run(parent_dir: Path = VIDEOS_PATH) -> None:
     """
 
     num_run = 0 # number of times anipose has been run (essentially number of dirs modified)
+    fs_index.refresh(parent_dir)
     nx_dirs = find_nx_dirs(parent_dir)
     for nxdir in nx_dirs: # run on all Nx dirs
         p_anipose = nxdir / 'anipose' 
@@ -68,7 +70,7 @@ def run(parent_dir: Path = VIDEOS_PATH) -> None:
             logger.warning(f"Anipose directory does not exist, skipping {nxdir}")
             continue
         logger.info(f"Found anipose directory {p_anipose}")
-        for p_n1 in p_anipose.glob('**/N1'):
+        for p_n1 in fs_index.rglob(p_anipose, 'N1', dirs=True):
             p_network = p_n1.parent.parent # anipose\Ball\<name of network set>\project\N1
             logger.info(f"Name of network set (directory): `{p_network.name}`")
 
@@ -99,5 +101,6 @@ def run(parent_dir: Path = VIDEOS_PATH) -> None:
             run_anipose_commands(p_network, p_calibration_target, parent_dir)
             num_run+=1
             logger.info(f'Finished running anipose in {p_network}')
+    fs_index.save()
     print(f"Finished running anipose in {num_run} projects...")
 
@@ -0,0 +1,94 @@
+"""
+benchmark_hdf.py: compare HDF write settings (format, compression, float32) on realistic DLC data
+
+Writes the same DLC-like data with every setting to the given directory (e.g. the network share
+the pipeline writes to), checks that it can be read back under the `df_with_missing` key
+that Anipose uses and prints write throughput and file size.
+
+Run from the unified_pipeline directory:
+    python scripts/benchmark_hdf.py <write_dir> --frames 2000 --repeats 5
+"""
+
+import argparse
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from src.clean import COLUMN_NAMES, COORDS
+from src.hdf import HDF_KEY, write_hdf
+
+# format, complib, complevel, float32
+SETTINGS = [
+    ("fixed", None, 0, False),
+    ("fixed", None, 0, True),
+    ("fixed", "blosc:lz4", 5, False),
+    ("fixed", "blosc:lz4", 5, True),
+    ("fixed", "blosc:zstd", 5, True),
+    ("fixed", "zlib", 1, False),
+    ("fixed", "zlib", 1, True),
+    ("table", None, 0, False),
+    ("table", "blosc:lz4", 5, True),
+]
+
+
+def dlc_frame(frames: int, bodyparts: int, seed: int = 0) -> pd.DataFrame:
+    """DLC-like data: smooth trajectories, some missing points and likelihood 1.0 as after cleaning"""
+    rng = np.random.default_rng(seed)
+    xy = 300 + np.cumsum(rng.normal(0, 1.5, (frames, bodyparts, 2)), axis=0)
+    xy[rng.random((frames, bodyparts)) < 0.05] = np.nan
+    values = np.concatenate([xy, np.ones((frames, bodyparts, 1))], axis=-1)
+
+    columns = pd.MultiIndex.from_product(
+        [["DLC_resnet101_benchmark"], [f"bp{i}" for i in range(bodyparts)], COORDS],
+        names=COLUMN_NAMES,
+    )
+    return pd.DataFrame(values.reshape(frames, -1), columns=columns)
+
+
+def benchmark(write_dir: Path, frames: int, bodyparts: int, repeats: int) -> None:
+    df = dlc_frame(frames, bodyparts)
+    size_mb = df.memory_usage(index=True).sum() / 1e6
+    print(f"DLC frame: {frames} frames x {bodyparts} bodyparts ({size_mb:.2f} MB in memory)")
+    print(f"{'format':<7}{'complib':<12}{'level':>6}{'float32':>9}{'MB/s':>10}{'file MB':>10}")
+
+    for fmt, complib, complevel, float32 in SETTINGS:
+        hdf_path = write_dir / f"benchmark-{fmt}-{complib}-{complevel}-{float32}.h5".replace(":", "_")
+        try:
+            start = time.perf_counter()
+            for _ in range(repeats):
+                write_hdf(df, hdf_path, fmt, complib, complevel, float32)
+            elapsed = (time.perf_counter() - start) / repeats
+        except (ValueError, ImportError) as e:  # compression library not available
+            print(f"{fmt:<7}{str(complib):<12}{complevel:>6}{str(float32):>9}  skipped: {e}")
+            continue
+
+        # must stay readable for Anipose
+        read = pd.read_hdf(hdf_path, HDF_KEY)
+        expected = df.astype(np.float32) if float32 else df
+        pd.testing.assert_frame_equal(read, expected)
+
+        file_mb = hdf_path.stat().st_size / 1e6
+        print(
+            f"{fmt:<7}{str(complib):<12}{complevel:>6}{str(float32):>9}{size_mb / elapsed:>10.1f}{file_mb:>10.2f}"
+        )
+        hdf_path.unlink()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare HDF write settings on DLC-like data")
+    parser.add_argument("write_dir", nargs="?", default=None, help="directory to write to, by default a temporary directory")
+    parser.add_argument("--frames", type=int, default=2000, help="number of frames, by default 2000 (10 s at 200 Hz)")
+    parser.add_argument("--bodyparts", type=int, default=38, help="number of bodyparts, by default 38")
+    parser.add_argument("--repeats", type=int, default=5, help="number of writes per setting, by default 5")
+    args = parser.parse_args()
+
+    if args.write_dir:
+        benchmark(Path(args.write_dir), args.frames, args.bodyparts, args.repeats)
+    else:
+        with tempfile.TemporaryDirectory() as tmp:
+            benchmark(Path(tmp), args.frames, args.bodyparts, args.repeats)
@@ -0,0 +1,82 @@
+"""
+detect_charuco.py: find the ChArUco board in calibration movies and write the corners per frame
+
+Writes <movie>_charuco.csv (the `id_data.csv` format of charuco-detection.ipynb) and, with --npy,
+<movie>_charuco.npy with the (frames, corners, 2) array (NaN where a corner was not found), and prints how well the
+board covers each camera's view. With --keyframes only keyframes with new board poses are detected, which is much
+faster on high frame rate movies. The movie is then also detected in full, and the coverage and run time of both
+are printed side by side to check the thresholds; pass --no-compare to skip the full run once they are chosen.
+
+Run from the unified_pipeline directory:
+    python scripts/detect_charuco.py common_files/calib-*.mp4 --workers 4 --keyframes
+"""
+
+import argparse
+import logging
+import sys
+import time
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from src.charuco import Sampling, coverage, detect_video, write_csv
+
+
+def format_stats(stats: dict) -> str:
+    return (
+        f"board in {stats['frames']} frames, {stats['corners']} corners, "
+        f"{stats['cells']:.0%} of the view covered, "
+        f"center spread {stats['spread_x']:.2f} x {stats['spread_y']:.2f}, size range {stats['scale']:.1f}x"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("movies", type=Path, nargs="+")
+    parser.add_argument("--out", type=Path, default=None, help="folder for the outputs, by default next to each movie")
+    parser.add_argument("--workers", type=int, default=1, help="number of detection processes")
+    parser.add_argument("--chunk-frames", type=int, default=500, help="frames per range handed to a process")
+    parser.add_argument("--npy", action="store_true", help="also save the corners as a numpy array")
+    parser.add_argument("--keyframes", action="store_true", help="only detect keyframes with new board poses")
+    parser.add_argument("--motion-threshold", type=float, default=Sampling().motion_threshold)
+    parser.add_argument("--min-pose-shift", type=float, default=Sampling().min_pose_shift)
+    parser.add_argument("--stride", type=int, default=Sampling().stride, help="only score every n-th frame")
+    parser.add_argument(
+        "--no-compare", action="store_true", help="with --keyframes, do not run the full detection for comparison"
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    sampling = (
+        Sampling(args.motion_threshold, args.min_pose_shift, stride=args.stride) if args.keyframes else None
+    )
+
+    for p_movie in args.movies:
+        start = time.perf_counter()
+        points = detect_video(p_movie, workers=args.workers, chunk_frames=args.chunk_frames, sampling=sampling)
+        seconds = time.perf_counter() - start
+        out_dir = args.out or p_movie.parent
+        out_dir.mkdir(parents=True, exist_ok=True)
+        write_csv(points, out_dir / f"{p_movie.stem}_charuco.csv")
+        if args.npy:
+            np.save(out_dir / f"{p_movie.stem}_charuco.npy", points)
+
+        cap = cv2.VideoCapture(str(p_movie))
+        image_size = (int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+        cap.release()
+        stats = coverage(points, image_size)
+        if sampling is None or args.no_compare:
+            print(f"{p_movie.name}: {format_stats(stats)}, {seconds:.1f} s")
+            continue
+
+        start = time.perf_counter()
+        full = detect_video(p_movie, workers=args.workers, chunk_frames=args.chunk_frames)
+        full_seconds = time.perf_counter() - start
+        print(f"{p_movie.name}:")
+        print(f"    full:    {format_stats(coverage(full, image_size))}, {full_seconds:.1f} s")
+        print(f"    sampled: {format_stats(stats)}, {seconds:.1f} s ({full_seconds / max(seconds, 1e-9):.1f}x faster)")
+
+
+if __name__ == "__main__":
+    main()
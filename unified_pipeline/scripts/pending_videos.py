@@ -0,0 +1,48 @@
+"""
+pending_videos.py: list the videos that still have to be analyzed with DLC, e.g. to plan overnight runs
+
+A video is pending if it has no DLC output for its model and, if a job ledger is given, it is not recorded
+as finished in the ledger (see `src.ledger`).
+
+Run from the unified_pipeline directory:
+    python scripts/pending_videos.py <videos_path> --ledger <ledger.sqlite> --durations
+"""
+
+import argparse
+import sys
+from pathlib import Path
+
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from config import settings
+from src.dlc import ModelRegistry, find_pending_videos
+from src.file_tools import load_config
+from src.ledger import JobLedger
+from src.video import video_duration
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("videos_path", type=Path, nargs="?", default=Path(settings.videos_path))
+    parser.add_argument("--networks", type=Path, default=Path("common_files/DLC_network_sets.yml"))
+    parser.add_argument("--ledger", type=Path, default=settings.get("dlc_ledger") or None)
+    parser.add_argument("--durations", action="store_true", help="read the video durations for a time estimate")
+    args = parser.parse_args()
+
+    ledger = JobLedger(args.ledger) if args.ledger else None
+    groups = find_pending_videos(args.videos_path, load_config(args.networks), ModelRegistry(), ledger)
+
+    total_videos = total_seconds = 0
+    for (context, cam_type, model_config_path), videos in groups.items():
+        seconds = sum(video_duration(v) for v in videos) if args.durations else 0
+        total_videos += len(videos)
+        total_seconds += seconds
+        print(f"{context} {cam_type}: {len(videos)} videos" + (f", {seconds:.0f} s of video" if args.durations else ""))
+        print(f"    model: {model_config_path}")
+        for video in videos:
+            print(f"    {video}")
+
+    print(f"{total_videos} videos pending" + (f", {total_seconds / 60:.1f} min of video" if args.durations else ""))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,193 @@
+"""
+Plan and generate the Anipose folder structure from the DLC outputs
+
+The DLC outputs are first indexed (experiment -> fly -> context -> camera -> cleaned data), then one explicit
+list of file operations is built per experiment and executed in a single pass.
+
+Anipose folder structure for one experiment:
+
+    anipose / <Ball, SS> / <network set name> / config.toml
+                                              / calibration / <calibration files>
+                                              / project / <N1, N2...Nx> / pose-2d / <Genotype-camName>.h5, <Genotype>-G.h5
+                                                                        / videos-raw
+"""
+
+import logging
+from collections import namedtuple
+from pathlib import Path
+
+from src.file_tools import get_genotype, place_files
+from src.hdf import create_file_name, write_hdf
+
+CONTEXTS = ["Ball", "SS"]
+
+# action: `mkdir`, `copy`, `touch` or `convert` (write `data` DF to HDF at `dest`)
+FileOp = namedtuple("FileOp", ["action", "dest", "source", "data"], defaults=[None, None])
+
+
+def index_dlc_outputs(processed: list) -> dict:
+    """Index the DLC outputs by experiment, fly, context and camera
+
+    Parameters
+    ----------
+    processed : list
+        List of tuples in the form (processed_df, dlc_output_path), the DF can be None if it is not loaded yet
+
+    Returns
+    -------
+    dict
+        {experiment dir: {fly: {context: {camera: (processed_df, dlc_output_path)}}}}
+    """
+    index = {}
+    for df, path in processed:
+        # <experiment> / <Nx> / <Ball, SS> / <camName>-<...>_filtered.h5
+        context_dir = path.parent
+        fly_dir = context_dir.parent
+        cam_name = path.name.split("-")[0]
+
+        if context_dir.name not in CONTEXTS:
+            logging.warning(f"Skipping {path}, not inside a `Ball` or `SS` folder")
+            continue
+
+        cams = (
+            index.setdefault(fly_dir.parent, {})
+            .setdefault(fly_dir.name, {})
+            .setdefault(context_dir.name, {})
+        )
+        if cam_name in cams:
+            logging.warning(
+                f"Found more than one DLC output for camera {cam_name} in {context_dir}, using {path.name}"
+            )
+        cams[cam_name] = (df, path)
+
+    return index
+
+
+def plan_anipose_files(
+    parent_dir: Path,
+    flies: dict,
+    network_set_names: dict,
+    calibration_files: list,
+    p_anipose_config: Path,
+    p_gcam_dummy: Path,
+    root: Path,
+    anipose_dir: Path = None,
+) -> list:
+    """List all file operations that generate the Anipose folder structure of one experiment
+
+    Parameters
+    ----------
+    parent_dir : Path
+        Experiment directory, the `anipose` folder will be placed here
+    flies : dict
+        Index of the experiment, {fly: {context: {camera: (processed_df, dlc_output_path)}}}, see `index_dlc_outputs`
+    network_set_names : dict
+        Context (Ball, SS) -> name of the DLC network set
+    calibration_files : list
+        Files that are copied to every `calibration` folder
+    p_anipose_config : Path
+        Anipose config, copied as `config.toml`
+    p_gcam_dummy : Path
+        Dummy file for camera G, copied to every `pose-2d` folder
+    root : Path
+        Root directory, used for the HDF file names
+    anipose_dir : Path, optional
+        Folder to generate the structure in instead of `parent_dir / "anipose"`, e.g. a temporary folder that
+        is renamed once all files are written
+
+    Returns
+    -------
+    list
+        FileOps in the order they have to be executed
+    """
+    plan = []
+    p_anipose = anipose_dir if anipose_dir is not None else parent_dir / "anipose"
+
+    for context in CONTEXTS:
+        fly_names = sorted(fly for fly, contexts in flies.items() if context in contexts)
+        if not fly_names:
+            continue
+
+        p_network = p_anipose / context / network_set_names[context]
+        p_calibration = p_network / "calibration"
+        plan.append(FileOp("mkdir", p_calibration))
+        plan += [FileOp("copy", p_calibration / Path(f).name, Path(f)) for f in calibration_files]
+        plan.append(FileOp("copy", p_network / "config.toml", p_anipose_config))
+
+        for fly in fly_names:
+            p_fly = p_network / "project" / fly
+            p_pose_2d = p_fly / "pose-2d"
+            plan.append(FileOp("mkdir", p_pose_2d))
+            plan.append(FileOp("mkdir", p_fly / "videos-raw"))
+
+            cams = flies[fly][context]
+            for cam_name in sorted(cams):
+                df, path = cams[cam_name]
+                try:
+                    # file name in the form GenotypeFlynum-camName
+                    hdf_name = create_file_name(path, root).with_suffix(".h5")
+                except ValueError:
+                    logging.critical(
+                        f"Incorrect root.\nYour root path {root} does not match with the parent directory of {path}"
+                    )
+                    continue
+                plan.append(FileOp("convert", p_pose_2d / hdf_name, path, df))
+
+            # Create the gcam dummy file name by filling in the genotype
+            any_path = next(iter(cams.values()))[1]
+            genotype = get_genotype(any_path, root)
+            plan.append(FileOp("copy", p_pose_2d / f"{genotype}-G.h5", p_gcam_dummy))
+
+    return plan
+
+
+def execute_plan(
+    plan: list, hdf_options: dict = None, placement: str = "copy", copy_workers: int = 4
+) -> list:
+    """Execute the file operations in one pass. Existing files are not overwritten.
+
+    `convert` operations without data are not executed but returned, so the caller can write them later.
+    `copy` operations are collected and placed together at the end, after all directories exist.
+
+    Parameters
+    ----------
+    plan : list
+        FileOps, see `plan_anipose_files`
+    hdf_options : dict, optional
+        Format, compression and float32 options, see `src.hdf.write_hdf`
+    placement : str, optional
+        How `copy` operations place their files: `copy`, `hardlink`, `symlink`, `reflink` or `auto`,
+        see `src.file_tools.place_file`, by default "copy"
+    copy_workers : int, optional
+        Number of threads for the files that are copied, by default 4
+
+    Returns
+    -------
+    list
+        The `convert` FileOps that were skipped because their data is not loaded yet
+    """
+    pending = []
+    copies = []
+    for op in plan:
+        if op.action == "mkdir":
+            if not op.dest.exists():
+                logging.info(f" Creating new directory {op.dest}")
+                op.dest.mkdir(parents=True)
+        elif op.dest.exists():
+            logging.warning(f"Skipping {op.dest} because it already exists")
+        elif op.action == "copy":
+            copies.append((op.source, op.dest))
+        elif op.action == "touch":
+            logging.info(f"Creating new file at: {op.dest}")
+            op.dest.touch()
+        elif op.action == "convert":
+            if op.data is None:
+                pending.append(op)
+                continue
+            logging.info(f"Writing to file {op.dest}")
+            write_hdf(op.data, op.dest, **(hdf_options or {}))
+        else:
+            raise ValueError(f"Unknown file operation `{op.action}`")
+
+    place_files(copies, placement, copy_workers)
+    return pending
@@ -0,0 +1,132 @@
+"""
+Persistent cache for cleaned DLC output, so reruns only clean the files that changed
+
+Entries are content-addressed: the key is a hash of the DLC output file, the cleaning
+configuration and the cleaning code (`src/clean.py`). Changing any of them creates a new entry,
+old entries are evicted by age and total size.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import time
+from pathlib import Path
+import pandas as pd
+
+import src.clean as clean
+from src.file_tools import file_signature, load_npz, save_npz
+
+CHUNK_SIZE = 2**20
+
+
+def code_version() -> str:
+    """Hash of the cleaning code, cached results are invalid once it changes"""
+    return hashlib.sha256(Path(clean.__file__).read_bytes()).hexdigest()
+
+
+def file_digest(path: Path) -> str:
+    """SHA-256 of the file content"""
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class ResultCache:
+    """Content-addressed store for cleaned DFs
+
+    Parameters
+    ----------
+    cache_dir : Path
+        Folder holding the cache, created if needed
+    max_bytes : int, optional
+        Evict least recently used entries once the cache is larger, 0 for no limit, by default 0
+    max_age_days : float, optional
+        Evict entries that have not been used for this many days, 0 for no limit, by default 0
+    """
+
+    def __init__(self, cache_dir: Path, max_bytes: int = 0, max_age_days: float = 0):
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        self.max_age_days = max_age_days
+        self._code_version = code_version()
+
+        (self.cache_dir / "results").mkdir(parents=True, exist_ok=True)
+        (self.cache_dir / "digests").mkdir(parents=True, exist_ok=True)
+
+    def digest(self, path: Path) -> str:
+        """Content hash of `path`, remembered per path/size/mtime so unchanged files are not read again"""
+        signature = "|".join(str(i) for i in file_signature(path))
+        p_memo = self.cache_dir / "digests" / hashlib.sha1(signature.encode()).hexdigest()
+        if p_memo.exists():
+            return p_memo.read_text()
+
+        digest = file_digest(path)
+        tmp = p_memo.with_name(p_memo.name + f".{os.getpid()}.tmp")
+        tmp.write_text(digest)
+        tmp.replace(p_memo)
+        return digest
+
+    def key(self, path: Path, config: dict) -> str:
+        """Cache key for the DLC output at `path` cleaned with `config`"""
+        parts = [
+            self.digest(path),
+            json.dumps(config, sort_keys=True, default=str),
+            self._code_version,
+        ]
+        return hashlib.sha256("\n".join(parts).encode()).hexdigest()
+
+    def _entry(self, key: str) -> Path:
+        return self.cache_dir / "results" / f"{key}.npz"
+
+    def get(self, key: str):
+        """Return the cached DF or None"""
+        p_entry = self._entry(key)
+        if not p_entry.exists():
+            return None
+        try:
+            _, columns, index, values = load_npz(p_entry)
+        except (OSError, ValueError, KeyError) as e:
+            logging.warning(f"Removing unreadable cache entry {p_entry}: {e}")
+            p_entry.unlink(missing_ok=True)
+            return None
+        os.utime(p_entry)  # mark as recently used
+        return pd.DataFrame(values, index=pd.Index(index), columns=columns, copy=False)
+
+    def put(self, key: str, df: pd.DataFrame) -> None:
+        """Store a cleaned DF"""
+        try:
+            save_npz(self._entry(key), df.columns, df.index, df.to_numpy())
+        except OSError as e:
+            logging.warning(f"Could not write cache entry for {key}: {e}")
+
+    def evict(self) -> None:
+        """Remove entries that are too old, then the least recently used ones until the cache fits `max_bytes`"""
+        entries = []
+        for p_entry in (self.cache_dir / "results").glob("*.npz"):
+            stat = p_entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, p_entry))
+        entries.sort()  # least recently used first
+
+        now = time.time()
+        total = sum(size for _, size, _ in entries)
+        removed = 0
+        for mtime, size, p_entry in entries:
+            too_old = self.max_age_days and now - mtime > self.max_age_days * 86400
+            too_big = self.max_bytes and total > self.max_bytes
+            if not (too_old or too_big):
+                continue
+            p_entry.unlink(missing_ok=True)
+            total -= size
+            removed += 1
+
+        # the remembered file digests are tiny, they are only removed by age
+        if self.max_age_days:
+            for p_memo in (self.cache_dir / "digests").iterdir():
+                if now - p_memo.stat().st_mtime > self.max_age_days * 86400:
+                    p_memo.unlink(missing_ok=True)
+
+        if removed:
+            logging.info(f"Evicted {removed} entries from result cache {self.cache_dir}")
@@ -3,10 +3,24 @@ Handle generating Anipose calibration files
 """
 
 import logging 
+import os
+from bisect import bisect_right
 from datetime import datetime
 from pathlib import Path
-from datetimerange import DateTimeRange
 import src.file_tools as file_tools
+import src.fs_index as fs_index
+from src.staging import StagingCache
+from config import settings
+
+# if true, gaps between the date ranges of calibration_timeline.yml are errors, otherwise they are logged
+STRICT_CALIBRATION_TIMELINE: bool = settings.get("strict_calibration_timeline", False)
+# if true, warn about experiments with videos recorded in two calibration periods (lists all videos of the experiment)
+CHECK_CALIBRATION_PERIODS: bool = settings.get("check_calibration_periods", False)
+# local folder that calibration files are copied to once per run, shared with the DLC staging
+STAGING_DIR: str = settings.get("staging_dir", "")
+STAGING_MAX_BYTES: int = int(settings.get("staging_max_gb", 0) * 1e9)
+# symlinks to the staging folder would break on other machines, so symlinked files are not staged
+FILE_PLACEMENT: str = settings.get("file_placement", "copy")
 
 def to_dt(date_string: str, time: bool = False) -> datetime:
     match = "%m%d%Y"  # only date
@@ -15,23 +29,227 @@ def to_dt(date_string: str, time: bool = False) -> datetime:
     return datetime.strptime(date_string, match)
 
 
-def get_date_time(p_project_dir: Path) -> datetime:
+def _listdir(dir_path: Path):
+    # (subdirectory names, file names), from the file index if it is used
+    if fs_index.USE_FS_INDEX:
+        return fs_index.get_index(dir_path).listdir(dir_path)
+    subdirs, files = [], []
+    try:
+        with os.scandir(dir_path) as it:
+            for e in it:
+                (subdirs if e.is_dir() else files).append(e.name)
+    except OSError:
+        return None
+    return subdirs, files
+
+
+def _iter_videos(p_project_dir: Path):
+    # recording videos in sorted path order, folders are only listed when the walk reaches them
+    stack = [(Path(p_project_dir), True)]
+    while stack:
+        path, is_dir = stack.pop()
+        if not is_dir:
+            yield path
+            continue
+        listing = _listdir(path)
+        if listing is None:
+            continue
+        subdirs, files = listing
+        # excludes the `calib-A` etc. calibration movies
+        files = [name for name in files if name.endswith(".mp4") and name.count("-") >= 2]
+        entries = sorted([(name, True) for name in subdirs] + [(name, False) for name in files], reverse=True)
+        stack += [(path / name, entry_is_dir) for name, entry_is_dir in entries]
+
+
+def _video_date_time(p_video: Path) -> datetime:
     # name format B-4182023151132-0000
+    return to_dt(p_video.name.split("-")[1], True)
 
-    mp4_files = [file for file in p_project_dir.glob('**/*.mp4') if file.name.count('-') >= 2] # Excludes the `calib-A` etc. calibration movies from the search
-    if not mp4_files:
+
+# experiment folder -> (datetime of its first video, (first, last) recording datetime or None if not walked)
+_recordings = {}
+
+
+def _scan_videos(p_project_dir: Path, full: bool) -> tuple:
+    # one walk for the first video and, if `full`, the recording range, kept for the rest of the run
+    key = str(p_project_dir)
+    cached = _recordings.get(key)
+    if cached is not None and (cached[1] is not None or not full):
+        return cached
+
+    first, date_times = None, []
+    for p_video in _iter_videos(p_project_dir):
+        try:
+            date_time = _video_date_time(p_video)
+        except ValueError:
+            logging.warning(f"Could not read the recording time from the name of {p_video}")
+            continue
+        first = first if first is not None else date_time
+        date_times.append(date_time)
+        if not full:
+            break
+    if first is None:
         raise ValueError("No valid .mp4 files found in the directory")
-    
-    mp4 = mp4_files[0] # First valid mp4 file, used to get datetime range
-    mp4_name = mp4.name
-    date_time_string = mp4_name.split('-')[1]
 
-    return to_dt(date_time_string, True)
+    _recordings[key] = (first, (min(date_times), max(date_times)) if full else None)
+    return _recordings[key]
+
+
+def get_date_time(p_project_dir: Path) -> datetime:
+    """Recording date and time of the first video (in path order) of an experiment
+
+    Stops at the first video with a valid name, or uses the walk of `get_recording_range` if that ran before.
+    The result is kept for the rest of the run.
+
+    Parameters
+    ----------
+    p_project_dir : Path
+        Experiment folder
+
+    Returns
+    -------
+    datetime
+        Date and time from the name of the video
+
+    Raises
+    ------
+    ValueError
+        If there are no videos with a valid name in the folder
+    """
+    return _scan_videos(p_project_dir, full=False)[0]
+
+
+def get_recording_range(p_project_dir: Path) -> tuple:
+    """Earliest and latest recording date and time of the videos of an experiment, kept for the rest of the run
+
+    Walks all videos of the experiment, the first one of `get_date_time` is found in the same walk.
+
+    Parameters
+    ----------
+    p_project_dir : Path
+        Experiment folder
+
+    Returns
+    -------
+    tuple
+        (first, last) datetime, videos with names that cannot be parsed are skipped
+
+    Raises
+    ------
+    ValueError
+        If there are no videos with a valid name in the folder
+    """
+    recording_range = _scan_videos(p_project_dir, full=True)[1]
+    if recording_range is None:
+        raise ValueError("No valid .mp4 files found in the directory")
+    return recording_range
+
+
+# (resolved path, parser) -> (mtime_ns, parsed file)
+_cache = {}
+
+
+def _load_cached(path: Path, parse):
+    # parse the file once and again only when its mtime changes
+    key = str(Path(path).resolve())
+    mtime = Path(path).stat().st_mtime_ns
+    cached = _cache.get((key, parse))
+    if cached is None or cached[0] != mtime:
+        cached = (mtime, parse(path))
+        _cache[(key, parse)] = cached
+    return cached[1]
+
+
+def normalize_path(path) -> tuple:
+    r"""Parts of a path for comparing, independent of case, `\` vs `/` and repeated separators
+
+    `\\server\share\a`, `//server/share/a/` and `\\SERVER\\share\a` give the same parts. UNC paths keep a
+    leading `//` on the server so they never match a drive or relative path.
+    """
+    path = str(path).replace("\\", "/")
+    parts = [part.casefold() for part in path.split("/") if part and part != "."]
+    if path.startswith("//") and parts:
+        parts[0] = "//" + parts[0]
+    return tuple(parts)
+
+
+class CalibrationTargets:
+    """Prefix tree of the folders in calibration_target.yml
+
+    Parameters
+    ----------
+    config : dict
+        Content of calibration_target.yml, lists of folders under `board` and `fly`
+    source : str, optional
+        Name of the file for log messages, by default ""
+    """
+
+    def __init__(self, config: dict, source: str = ""):
+        # node: {part: child node}, the calibration type of a folder is stored under the key None
+        self._root = {}
+        for calibration_type in ["board", "fly"]:
+            for path in (config or {}).get(calibration_type) or []:
+                self._add(path, calibration_type, source)
+
+    def _add(self, path: str, calibration_type: str, source: str) -> None:
+        parts = normalize_path(path or "")
+        if not parts:
+            logging.warning(f"{source}: ignoring empty {calibration_type} entry")
+            return
+        node = self._root
+        for part in parts:
+            if None in node:
+                logging.warning(
+                    f"{source}: `{path}` ({calibration_type}) is inside `{node[None][1]}` ({node[None][0]})"
+                )
+            node = node.setdefault(part, {})
+
+        if None in node:
+            other_type, other_path = node[None]
+            if other_type == calibration_type:
+                logging.warning(f"{source}: `{path}` is listed twice under {calibration_type} (as `{other_path}`)")
+            else:
+                logging.warning(
+                    f"{source}: `{path}` is listed under both {other_type} and {calibration_type}, using {other_type}"
+                )
+            return
+        for other_type, other_path in self._entries(node):
+            logging.warning(f"{source}: `{other_path}` ({other_type}) is inside `{path}` ({calibration_type})")
+        node[None] = (calibration_type, path)
+
+    def _entries(self, node: dict):
+        for part, child in node.items():
+            if part is None:
+                yield child
+            else:
+                yield from self._entries(child)
+
+    def lookup(self, p_project_dir: Path):
+        """Calibration type of a folder: "board" if it is or is inside a board folder, else "fly" if it is or is
+        inside a fly folder, else None"""
+        found = set()
+        node = self._root
+        for part in normalize_path(p_project_dir):
+            node = node.get(part)
+            if node is None:
+                break
+            if None in node:
+                found.add(node[None][0])
+        if "board" in found:
+            return "board"
+        return "fly" if "fly" in found else None
+
+
+def _parse_targets(path: Path) -> CalibrationTargets:
+    return CalibrationTargets(file_tools.load_config(path), source=str(path))
 
 
 def get_calibration_type(p_calibration_target: Path, p_project_dir: Path):
     """Return the calibration type of the directory based on the calibration_target file
 
+    The file is only read again when it changes. Paths are compared without regard to case and separators, see
+    `normalize_path`.
+
     Parameters
     ----------
     p_calibration_target : Path
@@ -44,63 +262,169 @@ def get_calibration_type(p_calibration_target: Path, p_project_dir: Path):
     String OR None
         Returns a string "board" or "fly" if the directory provided is board-based or fly-based calibration respectively. Returns None and gives a logging error to the user if the directory is not inside calibration_target or is not a child of a path in calibration_target.
     """
-    calibration_target_config = file_tools.load_config(p_calibration_target)
-
-    # all the file paths that use a board calibration
-    board_paths = calibration_target_config['board']
-    # all the file paths that use a fly calibration
-    fly_paths = calibration_target_config['fly']
-
-    # Checks if the list of paths exists, then if the project_dir is exactly any of the paths in calibration_target, then if project_dir is a child of any paths in project_dir
-    if board_paths and any(str(p_project_dir) == path or Path(path) in p_project_dir.parents for path in board_paths):
-        return "board"
-    elif fly_paths and any(str(p_project_dir) == path or Path(path) in p_project_dir.parents for path in fly_paths):
-        return "fly"
-    else:
-        return None
+    return _load_cached(p_calibration_target, _parse_targets).lookup(p_project_dir)
 
 
-def get_anipose_calibration_files(p_calibration_target: Path, p_calibration_timeline: Path, p_project_dir: Path) -> list:
-    p_calibration_files = ""
+class CalibrationTimeline:
+    """Sorted date ranges of calibration_timeline.yml, looked up with a binary search
+
+    A range covers its start day and ends at midnight at the start of its end day, ranges may touch at that midnight.
+
+    Parameters
+    ----------
+    config : dict
+        Content of calibration_timeline.yml, calibration folder -> "MMDDYYYY - MMDDYYYY"
+    source : str, optional
+        Name of the file for messages, by default ""
+    strict : bool, optional
+        Raise a ValueError for gaps between ranges instead of logging a warning, by default False
+
+    Raises
+    ------
+    ValueError
+        If a range cannot be parsed, ends before it starts or overlaps another range
+    """
+
+    def __init__(self, config: dict, source: str = "", strict: bool = False):
+        ranges = []
+        for path, daterange in (config or {}).items():
+            try:
+                start, end = (to_dt(d.strip()) for d in daterange.split("-"))
+            except (AttributeError, ValueError) as e:
+                raise ValueError(
+                    f"{source}: invalid date range `{daterange}` for `{path}`, expected MMDDYYYY - MMDDYYYY"
+                ) from e
+            if end < start:
+                raise ValueError(f"{source}: date range `{daterange}` of `{path}` ends before it starts")
+            ranges.append((start, end, path))
+        ranges.sort(key=lambda r: r[:2])
+
+        for (_, prev_end, prev_path), (start, _, path) in zip(ranges, ranges[1:]):
+            if start < prev_end:
+                raise ValueError(f"{source}: date ranges of `{prev_path}` and `{path}` overlap")
+            if start > prev_end:
+                message = f"{source}: no calibration from {prev_end:%m/%d/%Y} to {start:%m/%d/%Y}"
+                if strict:
+                    raise ValueError(message)
+                logging.warning(message)
+
+        self._starts = [start for start, _, _ in ranges]
+        self._ranges = ranges
+
+    def lookup(self, date: datetime):
+        """Calibration folder whose range contains `date`, the earlier one if two ranges touch at `date`,
+        None if no range contains it"""
+        i = bisect_right(self._starts, date) - 1
+        if i > 0 and self._ranges[i - 1][1] >= date:
+            i -= 1
+        if i < 0 or self._ranges[i][1] < date:
+            return None
+        return Path(self._ranges[i][2])
+
 
-    # specifies which calibration to use based on the timestamp on filename
-    calibration_timeline = file_tools.load_config(p_calibration_timeline)
+def _parse_timeline(path: Path) -> CalibrationTimeline:
+    return CalibrationTimeline(file_tools.load_config(path), source=str(path), strict=STRICT_CALIBRATION_TIMELINE)
 
+
+# calibration folder -> (detections.pickle, calibration.toml) found in it
+_bundles = {}
+_staging = None
+
+
+def resolve_calibration_bundle(p_calibration_files: Path):
+    """detections.pickle and calibration.toml of a calibration folder, searched only once per folder and run
+
+    Parameters
+    ----------
+    p_calibration_files : Path
+        Calibration folder from calibration_timeline.yml
+
+    Returns
+    -------
+    tuple or None
+        (detections.pickle, calibration.toml), None if either is missing
+    """
+    key = str(p_calibration_files)
+    if key not in _bundles:
+        p_detection_pickle = next(p_calibration_files.glob('**/detections.pickle'), None)
+        p_calibration_toml = next(p_calibration_files.glob('**/calibration.toml'), None)
+        if p_detection_pickle is None or p_calibration_toml is None:
+            logging.error(f"detections.pickle or calibration.toml missing in `{p_calibration_files}`")
+            return None
+        _bundles[key] = (p_detection_pickle, p_calibration_toml)
+    return _bundles[key]
+
+
+def stage_files(files: list) -> list:
+    """Local copies of files on the share if `staging_dir` is set, otherwise the files themselves
+
+    Copies are made once and reused by later experiments until the size or mtime of the source changes. They are
+    keyed on the source path rather than the content (see `src.staging`), so the same bundle in two calibration
+    folders is copied twice.
+    With `file_placement = "symlink"` the files on the share are returned, the anipose folders must not link
+    to the local copies. The copies can be evicted once `close_staging` is called.
+    """
+    global _staging
+    if not STAGING_DIR or FILE_PLACEMENT == "symlink":
+        return list(files)
+    if _staging is None:
+        _staging = StagingCache(STAGING_DIR, STAGING_MAX_BYTES)
+    _staging.prefetch(files)
+    staged = [_staging.stage(p) for p in files]
+    # only evicted in `close_staging`, after the files are placed
+    _staging.release(files)
+    return staged
+
+
+def close_staging() -> None:
+    """Evict the staged calibration files above `staging_max_gb`, they are staged again when needed"""
+    global _staging
+    if _staging is not None:
+        _staging.close()
+        _staging = None
+
+
+def get_anipose_calibration_files(p_calibration_target: Path, p_calibration_timeline: Path, p_project_dir: Path) -> list:
+    # specifies which calibration to use based on the timestamp on filename, parsed again only when it changes
+    calibration_timeline = _load_cached(p_calibration_timeline, _parse_timeline)
+
+    # the period check walks all videos, the first one is found in the same walk
+    if CHECK_CALIBRATION_PERIODS:
+        get_recording_range(p_project_dir)
     # gets the datetime string from filename
     project_date = get_date_time(p_project_dir)
 
-    for path, daterange in calibration_timeline.items():
-        start = daterange.split("-")[0].strip()  # Start datetime
-        end = daterange.split("-")[1].strip()  # end datetime
-        dt_start = to_dt(start)
-        dt_end = to_dt(end)
-        # Create a date range (this just starts and ends at midnight since the time doesn't matter)
-        dt_daterange = DateTimeRange(dt_start, dt_end)
-        if project_date in dt_daterange:  # determine if the project falls in the date range
-            p_calibration_files = Path(path)
-            break
-    else:
+    p_calibration_files = calibration_timeline.lookup(project_date)
+    if p_calibration_files is None:
         logging.error(
             f"The project date (`{project_date}`) of the directory `{p_project_dir}` does not fall into any date range in calibration_timeline: `{p_calibration_timeline}`")
         return
 
+    if CHECK_CALIBRATION_PERIODS:
+        first, last = get_recording_range(p_project_dir)
+        periods = {calibration_timeline.lookup(first), calibration_timeline.lookup(last)}
+        if len(periods) > 1:
+            logging.warning(
+                f"The videos of `{p_project_dir}` were recorded from {first} to {last}, which spans more than one "
+                f"calibration in `{p_calibration_timeline}`, using `{p_calibration_files}`"
+            )
+
     output_files = []
     p_common_files = Path('../common_files')
     if p_calibration_files and p_calibration_files.exists():  # calibration file dir found
         calibration_type = get_calibration_type(
             p_calibration_target, p_project_dir)
-        p_detection_pickle = next(
-            p_calibration_files.glob('**/detections.pickle'))
-        p_calibration_toml = next(
-            p_calibration_files.glob('**/calibration.toml'))
-
+        bundle = resolve_calibration_bundle(p_calibration_files)
+        if bundle is None:
+            return
+        p_detection_pickle, p_calibration_toml = stage_files(bundle)
 
         if calibration_type == 'board':
             # Board calibration needs both files
             output_files.append(p_detection_pickle)
             output_files.append(p_calibration_toml)
         elif calibration_type == 'fly':
-            p_calib_movies = list(p_common_files.glob("*.mp4"))
+            p_calib_movies = stage_files(sorted(p_common_files.glob("*.mp4")))
 
             # Fly-based calibration only requires detections.pickle
             output_files.append(p_detection_pickle)
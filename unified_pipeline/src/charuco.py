@@ -0,0 +1,395 @@
+"""
+Detect the ChArUco calibration board in calibration movies, e.g. to quality control the Anipose calibration
+
+Replaces `analyze_images` of charuco-detection/charuco-detection.ipynb: the frames are decoded straight from the
+movie instead of from extracted PNGs, and the movie is split into frame ranges that are detected in parallel by a
+pool of processes, each with its own board and detector. The result is one array of shape (frames, corners, 2) with
+the pixel coordinates of every inner board corner, NaN where a corner was not found.
+
+With `sampling` set, only keyframes are detected: every `stride`-th frame is scored by its mean difference to the
+last keyframe on a downscaled copy, which is cheap, and a frame becomes a keyframe once the image changed enough. The
+frames in between are only grabbed, not converted. After the ranges are merged, a keyframe is kept only if the board
+moved to a new pose, so the output holds a few distinct poses instead of hundreds of nearly identical frames
+(200 fps). Compare `coverage` of a full and a sampled run to check the calibration is still covered.
+
+A full detection costs about as much as decoding and scoring ten frames, so the defaults aim at both: scoring every
+5th frame (40 fps at 200 fps) and a motion threshold that leaves roughly one keyframe in 20 frames.
+
+Works with the ArUco API of OpenCV before 4.7 (`aruco.detectMarkers` and `aruco.interpolateCornersCharuco`) and
+after (`aruco.CharucoDetector`).
+"""
+
+import csv
+import logging
+import multiprocessing
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+# the board of the notebook: 6 x 6 squares (5 x 5 = 25 inner corners) with markers from DICT_6X6_50
+BoardSpec = namedtuple(
+    "BoardSpec",
+    ["squares_x", "squares_y", "square_length", "marker_length", "dictionary", "legacy_pattern"],
+    defaults=[6, 6, 0.5, 0.375, cv2.aruco.DICT_6X6_50, True],
+)
+
+# a board counts as detected with more than this many corners, as in the notebook
+MIN_CORNERS = 3
+
+# adaptive frame sampling, see `detect_video`
+# motion_threshold: mean absolute gray value difference (0-255) to the last keyframe that makes a new keyframe
+# min_pose_shift: mean corner displacement in pixels to every kept pose for a detection to count as a new pose
+# scale_width: width in pixels of the downscaled frames that are scored
+# stride: only every stride-th frame (counted from the start of the movie) is scored, the others are not converted
+Sampling = namedtuple(
+    "Sampling", ["motion_threshold", "min_pose_shift", "scale_width", "stride"], defaults=[8.0, 10.0, 160, 5]
+)
+
+
+def n_corners(spec: BoardSpec) -> int:
+    """Number of inner corners of a board"""
+    return (spec.squares_x - 1) * (spec.squares_y - 1)
+
+
+def make_board(spec: BoardSpec = BoardSpec()):
+    """Board and marker dictionary for either ArUco API
+
+    Parameters
+    ----------
+    spec : BoardSpec, optional
+        Board geometry, by default the board of the notebook
+
+    Returns
+    -------
+    tuple
+        (board, dictionary)
+    """
+    aruco = cv2.aruco
+    if hasattr(aruco, "CharucoDetector"):
+        dictionary = aruco.getPredefinedDictionary(spec.dictionary)
+        board = aruco.CharucoBoard(
+            (spec.squares_x, spec.squares_y), spec.square_length, spec.marker_length, dictionary
+        )
+        # boards printed with OpenCV < 4.6 have a different marker layout if the number of rows is even
+        if spec.legacy_pattern and hasattr(board, "setLegacyPattern"):
+            board.setLegacyPattern(True)
+    else:
+        dictionary = aruco.Dictionary_get(spec.dictionary)
+        board = aruco.CharucoBoard_create(
+            squaresX=spec.squares_x,
+            squaresY=spec.squares_y,
+            squareLength=spec.square_length,
+            markerLength=spec.marker_length,
+            dictionary=dictionary,
+        )
+    return board, dictionary
+
+
+def draw_board(spec: BoardSpec = BoardSpec(), size: tuple = (600, 600), margin: int = 0) -> np.ndarray:
+    """Image of the board, e.g. to print it or to render test frames"""
+    board, _ = make_board(spec)
+    if hasattr(board, "generateImage"):
+        return board.generateImage(size, marginSize=margin)
+    return board.draw(size, marginSize=margin)
+
+
+class BoardDetector:
+    """Finds the inner corners of one board in grayscale images
+
+    Parameters
+    ----------
+    spec : BoardSpec, optional
+        Board geometry, by default the board of the notebook
+    """
+
+    def __init__(self, spec: BoardSpec = BoardSpec()):
+        self.spec = spec
+        self.n_corners = n_corners(spec)
+        self.board, self.dictionary = make_board(spec)
+        self._detector = cv2.aruco.CharucoDetector(self.board) if hasattr(cv2.aruco, "CharucoDetector") else None
+
+    def _detect(self, gray: np.ndarray):
+        if self._detector is not None:
+            corners, ids, _, _ = self._detector.detectBoard(gray)
+            return corners, ids
+        marker_corners, marker_ids, _ = cv2.aruco.detectMarkers(image=gray, dictionary=self.dictionary)
+        if marker_ids is None or len(marker_ids) == 0:
+            return None, None
+        _, corners, ids = cv2.aruco.interpolateCornersCharuco(
+            markerCorners=marker_corners, markerIds=marker_ids, image=gray, board=self.board
+        )
+        return corners, ids
+
+    def detect(self, gray: np.ndarray) -> np.ndarray:
+        """Corner positions in one image
+
+        Parameters
+        ----------
+        gray : np.ndarray
+            Grayscale image
+
+        Returns
+        -------
+        np.ndarray
+            (corners, 2) pixel coordinates, all NaN if the board was not found
+        """
+        points = np.full((self.n_corners, 2), np.nan, dtype=np.float32)
+        try:
+            corners, ids = self._detect(gray)
+        except cv2.error as e:
+            logging.debug(f"ChArUco detection failed: {e}")
+            return points
+        if ids is not None and len(ids) > MIN_CORNERS:
+            points[ids.ravel()] = corners.reshape(-1, 2)
+        return points
+
+
+def count_frames(p_video: Path) -> int:
+    """Number of frames in the header of a video
+
+    Raises
+    ------
+    OSError
+        If the video cannot be opened or its header has no positive frame count
+    """
+    cap = cv2.VideoCapture(str(p_video))
+    try:
+        if not cap.isOpened():
+            raise OSError(f"Could not open {p_video}")
+        n_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    finally:
+        cap.release()
+    if n_frames <= 0:
+        raise OSError(f"Could not read the frame count of {p_video} (got {n_frames})")
+    return n_frames
+
+
+def iter_frames(p_video: Path, start: int = 0, end: int = None, step: int = 1):
+    """Yield (frame index, grayscale frame) of a video from `start` to `end` (exclusive), decoded one at a time
+
+    With `step` > 1 only frames with an index divisible by `step` are yielded, the others are grabbed but not
+    retrieved or converted.
+    """
+    cap = cv2.VideoCapture(str(p_video))
+    try:
+        if not cap.isOpened():
+            raise OSError(f"Could not open {p_video}")
+        if start:
+            cap.set(cv2.CAP_PROP_POS_FRAMES, start)
+        i = start
+        while end is None or i < end:
+            if i % step:
+                if not cap.grab():
+                    break
+                i += 1
+                continue
+            ok, frame = cap.read()
+            if not ok:
+                break
+            yield i, cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY) if frame.ndim == 3 else frame
+            i += 1
+    finally:
+        cap.release()
+
+
+# one detector per worker process, built once by `_init_worker`
+_detector = None
+
+
+def _init_worker(spec: BoardSpec) -> None:
+    global _detector
+    _detector = BoardDetector(spec)
+
+
+def _is_new_pose(points: np.ndarray, poses: list, min_shift: float) -> bool:
+    # a detection is a new pose unless its corners are within `min_shift` pixels (mean) of a kept pose
+    for pose in poses:
+        common = np.isfinite(points[:, 0]) & np.isfinite(pose[:, 0])
+        if common.sum() > MIN_CORNERS and np.linalg.norm(points[common] - pose[common], axis=1).mean() < min_shift:
+            return False
+    return True
+
+
+def _detect_range(p_video: Path, start: int, end: int, sampling: Sampling = None) -> tuple:
+    # (start, corners of the frames start..end, number of frames detected) for one worker
+    # with sampling, the corners of every keyframe are returned, the poses are deduplicated by `detect_video`
+    n_points = _detector.n_corners
+    points, n_detected = np.full((end - start, n_points, 2), np.nan, dtype=np.float32), 0
+    reference = None
+    step = sampling.stride if sampling is not None else 1
+    for i, gray in iter_frames(p_video, start, end, step):
+        if sampling is None:
+            points[i - start] = _detector.detect(gray)
+            n_detected += 1
+            continue
+
+        height, width = gray.shape
+        small = cv2.resize(
+            gray, (sampling.scale_width, max(1, height * sampling.scale_width // width)), interpolation=cv2.INTER_AREA
+        )
+        if reference is not None and cv2.mean(cv2.absdiff(small, reference))[0] < sampling.motion_threshold:
+            continue
+
+        # keyframe
+        reference = small
+        points[i - start] = _detector.detect(gray)
+        n_detected += 1
+
+    return start, points, n_detected
+
+
+def _keep_new_poses(points: np.ndarray, min_shift: float) -> int:
+    # in frame order, clear the detections that repeat a kept pose, returns the number of kept poses
+    poses = []
+    for i in np.flatnonzero(np.isfinite(points[:, :, 0]).any(axis=1)):
+        if _is_new_pose(points[i], poses, min_shift):
+            poses.append(points[i])
+        else:
+            points[i] = np.nan
+    return len(poses)
+
+
+def detect_video(
+    p_video: Path,
+    spec: BoardSpec = BoardSpec(),
+    workers: int = 1,
+    chunk_frames: int = 500,
+    sampling: Sampling = None,
+) -> np.ndarray:
+    """Board corners in every frame of a calibration movie, or only in keyframes with new board poses
+
+    Parameters
+    ----------
+    p_video : Path
+        Calibration movie, e.g. common_files/calib-A.mp4
+    spec : BoardSpec, optional
+        Board geometry, by default the board of the notebook
+    workers : int, optional
+        Number of processes, each decodes and detects its own frame ranges, 1 runs in this process, by default 1
+    chunk_frames : int, optional
+        Frames per range handed to a process, by default 500
+    sampling : Sampling, optional
+        Only detect keyframes and keep new poses, see `Sampling`, by default every frame is detected.
+        The first scored frame of each range is always a keyframe, the poses are deduplicated over all ranges,
+        so such a keyframe is only kept if its pose is new
+
+    Returns
+    -------
+    np.ndarray
+        (frames, corners, 2) float32 pixel coordinates of the inner corners, NaN where not found or not sampled
+    """
+    n_frames = count_frames(p_video)
+    ranges = [(start, min(start + chunk_frames, n_frames)) for start in range(0, n_frames, chunk_frames)]
+    result = np.full((n_frames, n_corners(spec), 2), np.nan, dtype=np.float32)
+
+    n_detected = 0
+    if workers <= 1:
+        _init_worker(spec)
+        chunks = (_detect_range(p_video, start, end, sampling) for start, end in ranges)
+        for start, points, n in chunks:
+            result[start : start + len(points)] = points[: n_frames - start]
+            n_detected += n
+    else:
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(workers, mp_context=context, initializer=_init_worker, initargs=(spec,)) as executor:
+            futures = [executor.submit(_detect_range, p_video, start, end, sampling) for start, end in ranges]
+            for future in futures:
+                start, points, n = future.result()
+                result[start : start + len(points)] = points[: n_frames - start]
+                n_detected += n
+
+    if sampling is not None:
+        n_poses = _keep_new_poses(result, sampling.min_pose_shift)
+        logging.info(f"Kept {n_poses} distinct board poses of {Path(p_video).name}")
+
+    found = np.isfinite(result[:, :, 0]).any(axis=1).sum()
+    logging.info(
+        f"Found the board in {found} of {n_frames} frames of {Path(p_video).name} ({n_detected} frames detected)"
+    )
+    return result
+
+
+def coverage(points: np.ndarray, image_size: tuple, spec: BoardSpec = BoardSpec(), grid: tuple = (8, 6)) -> dict:
+    """Statistics of how well the detected corners cover a camera's view, to compare full and sampled detection
+
+    Parameters
+    ----------
+    points : np.ndarray
+        (frames, corners, 2) array from `detect_video`
+    image_size : tuple
+        (width, height) of the frames
+    spec : BoardSpec, optional
+        Board geometry, by default the board of the notebook
+    grid : tuple, optional
+        The image is divided into this many (columns, rows) cells, by default (8, 6)
+
+    Returns
+    -------
+    dict
+        frames: frames with the board, corners: corners found in all frames, cells: fraction of grid cells with
+        at least one corner, spread_x/spread_y: standard deviation of the board center across frames as a
+        fraction of the image width/height, scale: range of board sizes in the image (95th / 5th percentile of the
+        mean distance between neighboring corners)
+    """
+    width, height = image_size
+    detected = points[np.isfinite(points[:, :, 0]).any(axis=1)]
+    corners = detected[np.isfinite(detected[:, :, 0])]
+    stats = {"frames": len(detected), "corners": len(corners), "cells": 0.0, "spread_x": 0.0, "spread_y": 0.0}
+    stats["scale"] = 0.0
+    if not len(detected):
+        return stats
+
+    cols = np.clip((corners[:, 0] / width * grid[0]).astype(int), 0, grid[0] - 1)
+    rows = np.clip((corners[:, 1] / height * grid[1]).astype(int), 0, grid[1] - 1)
+    stats["cells"] = len(set(zip(cols, rows))) / (grid[0] * grid[1])
+
+    centers = np.nanmean(detected, axis=1)
+    stats["spread_x"] = float(np.std(centers[:, 0]) / width)
+    stats["spread_y"] = float(np.std(centers[:, 1]) / height)
+    # distance between neighboring corners in a row, does not depend on how much of the board was found
+    rows_of_corners = detected.reshape(len(detected), spec.squares_y - 1, spec.squares_x - 1, 2)
+    spacing = np.linalg.norm(np.diff(rows_of_corners, axis=2), axis=3).reshape(len(detected), -1)
+    sizes = np.array([s[np.isfinite(s)].mean() for s in spacing if np.isfinite(s).any()])
+    if len(sizes):
+        low, high = np.percentile(sizes, [5, 95])
+        stats["scale"] = float(high / low) if low > 0 else 0.0
+    return stats
+
+
+def write_csv(
+    points: np.ndarray,
+    p_csv: Path,
+    scorer: str = "DLC_resnet50_Rightonly_FMHMay22shuffle1_750000",
+    likelihood: float = 0.9,
+) -> None:
+    """Write corners in the DLC-style CSV of the notebook (`id_data.csv`): one row per frame, x, y and a fixed
+    likelihood per corner, empty where the corner was not found
+
+    Parameters
+    ----------
+    points : np.ndarray
+        (frames, corners, 2) array from `detect_video`
+    p_csv : Path
+        CSV file to write
+    scorer : str, optional
+        Scorer in the first header row, by default the one of the notebook
+    likelihood : float, optional
+        Likelihood written for every found corner, by default 0.9
+    """
+    n_points = points.shape[1]
+    header = [
+        ["scorer"] + [scorer] * 3 * n_points,
+        ["bodyparts"] + [str(i) for i in range(n_points) for _ in range(3)],
+        ["coords"] + ["x", "y", "likelihood"] * n_points,
+    ]
+    with open(p_csv, "w", encoding="UTF8", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerows(header)
+        for i, frame in enumerate(points):
+            row = [str(i)]
+            for x, y in frame:
+                row += ["", "", ""] if np.isnan(x) else [x, y, likelihood]
+            writer.writerow(row)
@@ -1,76 +1,306 @@
 """
 Any preprocessing functions that will run on the DLC output before it is sent to Anipose will go here
 
-Note: all make changes to *copy* of the original DF and return a copy.
-Note: all operate on the multi-indexed dataframe that has index ('scorer', 'bodyparts', 'coords')
+The x/y/likelihood block of the multi-indexed dataframe (index ('scorer', 'bodyparts', 'coords')) is pulled
+out once into a `PoseFrame`, a working buffer of shape (frames, bodyparts, 3), and every registered step changes
+that buffer in place. The dataframe is only built once at the end. New cleaning steps are added with `register_step`.
+
+Note: the dataframe functions (`clean_frame`, `fix_point`, `remove_cols`, `replace_likelihood`) run the same steps
+on a *copy* of the original DF and return a new DF.
 """
 
+import logging
+import numpy as np
 import pandas as pd
 
-def replace_likelihood(df: pd.DataFrame) -> pd.DataFrame:
+COORDS = ["x", "y", "likelihood"]
+COLUMN_NAMES = ["scorer", "bodyparts", "coords"]
+
+# Registered cleaning steps: name -> function(pose, cam_name, **options)
+CLEANING_STEPS = {}
+
+
+def register_step(name: str):
+    """Decorator to register a function as a cleaning step under `name`.
+
+    A step is called as `step(pose, cam_name, **options)` and changes the `PoseFrame` in place.
     """
-    Replace `likelihood` column values with 1.0
+
+    def decorator(func):
+        CLEANING_STEPS[name] = func
+        return func
+
+    return decorator
+
+
+class PoseFrame:
+    """Working buffer holding the x/y/likelihood block of a DLC dataframe
+
+    Attributes
+    ----------
+    values : np.ndarray
+        Array of shape (frames, bodyparts, 3) with the coords in the order x, y, likelihood
+    keys : list
+        List of (scorer, bodypart) tuples, one for each entry along the bodyparts axis
+    index : pd.Index
+        Frame index of the dataframe
     """
-    
-    df_new = df.copy() 
 
-    MAX_LIKELIHOOD = 1.0
+    def __init__(self, values: np.ndarray, keys: list, index: pd.Index):
+        self.values = values
+        self.keys = list(keys)
+        self.index = index
 
-    # Selects all from other two indexes and then only `likelihood` from the third (coord)
-    df_new.loc[:, (slice(None), slice(None), 'likelihood')] = MAX_LIKELIHOOD
+    @classmethod
+    def from_arrays(cls, columns: pd.MultiIndex, index, values: np.ndarray) -> "PoseFrame":
+        """Use a float array of shape (frames, columns) as working buffer, e.g. from `file_tools.read_dlc_csv`
 
-    return df_new
+        Parameters
+        ----------
+        columns : pd.MultiIndex
+            Column index with the levels ('scorer', 'bodyparts', 'coords')
+        index : array-like
+            Frame index
+        values : np.ndarray
+            C-contiguous float array of shape (frames, columns), changed in place by the cleaning steps
+        """
+        n_bodyparts = len(columns) // 3
+        if list(columns.get_level_values(-1)) != COORDS * n_bodyparts:
+            raise ValueError(
+                "Expected the coords of every bodypart to be ordered as `x`, `y`, `likelihood`"
+            )
 
-#! Note: fix point only on x,y not x2,y2,...xn,yn; can be changed if necessary to have x2..xn and y2..yn
-def fix_point(df: pd.DataFrame, col_names: list, n: int = 1) -> pd.DataFrame:
-    """Replace all values in a DataFrame corresponding to DLC CSV data with one value. 
-    This is useful for a point that should stay fixed. Missing values are conserved. 
-    Original file is overwritten.
+        scorers = columns.get_level_values(0)[::3]
+        bodyparts = columns.get_level_values(1)[::3]
+        index = pd.Index(index)
+
+        return cls(values.reshape(len(index), n_bodyparts, 3), zip(scorers, bodyparts), index)
+
+    @classmethod
+    def from_df(cls, df: pd.DataFrame, copy: bool = True) -> "PoseFrame":
+        """Extract the x/y/likelihood block of a DLC dataframe as one contiguous array
+
+        Parameters
+        ----------
+        df : pd.DataFrame
+            Panda DataFrame representing DLC CSV data
+        copy : bool, optional
+            If False, the data of `df` may be reused as the working buffer and `df` must not be used
+            afterwards, by default True
+        """
+        values = df.to_numpy(dtype=float)
+        if copy or not values.flags.writeable or not values.flags.c_contiguous:
+            values = np.array(values, dtype=float, order="C")
+
+        return cls.from_arrays(df.columns, df.index, values)
+
+    @property
+    def bodyparts(self) -> np.ndarray:
+        return np.array([bodypart for _, bodypart in self.keys], dtype=str)
+
+    def drop(self, keep: np.ndarray) -> None:
+        """Remove bodyparts in place, `keep` is a boolean mask along the bodyparts axis"""
+        if keep.all():
+            return
+        # move the kept bodyparts to the front of the buffer and keep a view on them
+        kept = np.flatnonzero(keep)
+        for dst, src in enumerate(kept):
+            if dst != src:
+                self.values[:, dst] = self.values[:, src]
+        self.values = self.values[:, : len(kept)]
+        self.keys = [key for key, k in zip(self.keys, keep) if k]
+
+    def to_df(self) -> pd.DataFrame:
+        """Build the multi-indexed DLC dataframe from the working buffer
+
+        Returns
+        -------
+        pd.DataFrame
+            Full dataframe (representing DLC CSV)
+        """
+        columns = pd.MultiIndex.from_tuples(
+            [(scorer, bodypart, coord) for scorer, bodypart in self.keys for coord in COORDS],
+            names=COLUMN_NAMES,
+        )
+        values = self.values.reshape(len(self.index), -1)
+        return pd.DataFrame(values, index=self.index, columns=columns, copy=False)
+
+
+@register_step("fix_point")
+def fix_point_step(pose: PoseFrame, cam_name: str, bodyparts: list = (), n: int = 1) -> None:
+    """Vectorized fix point on the working buffer, see `fix_point`
 
     Parameters
     ----------
-    df: DataFrame 
-        Panda DataFrame representing CSV data 
-    col_name : str, optional
-        Name of the columns
+    pose : PoseFrame
+        Working buffer, changed in place
+    cam_name : str
+        Camera letter name, unused
+    bodyparts : list, optional
+        Names of the bodyparts which will have their points fixed
     n : int, optional
         Replace values with nth entry. To replace with the mean of whole column, choose 0, by default 1
+    """
+    selection = np.isin(pose.bodyparts, list(bodyparts))
+    if not selection.any() or len(pose.index) == 0:
+        return
+
+    xy = pose.values[:, selection, :2]  # (frames, selected bodyparts, x/y)
+    mask = ~np.isnan(xy)
+    counts = mask.sum(axis=0)
+
+    # nth non-missing value, only used if both x and y have at least n non-missing values
+    use_nth = (n > 0) & (counts.min(axis=-1) >= n)
+    nth_row = np.argmax(mask & (np.cumsum(mask, axis=0) == max(n, 1)), axis=0)
+    nth_value = np.take_along_axis(xy, nth_row[np.newaxis], axis=0)[0]
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        mean_value = np.nansum(xy, axis=0) / counts  # nan if the column is empty
+
+    replace_value = np.where(use_nth[:, np.newaxis], nth_value, mean_value)
+
+    # Missing values are conserved
+    pose.values[:, selection, :2] = np.where(mask, replace_value, np.nan)
+
+
+@register_step("remove_cols")
+def remove_cols_step(
+    pose: PoseFrame, cam_name: str, prefixes: dict = None, start: str = ""
+) -> None:
+    """Remove bodyparts from the working buffer, see `remove_cols`
+
+    Parameters
+    ----------
+    pose : PoseFrame
+        Working buffer, changed in place
+    cam_name : str
+        Camera letter name, used to look up the prefix
+    prefixes : dict, optional
+        Camera letter name -> remove bodyparts whose name starts with this string
+    start : str, optional
+        Remove bodyparts whose name starts with this string for any camera not in `prefixes`
+    """
+    start = (prefixes or {}).get(cam_name, start)
+    if not start:
+        return
+    logging.info(f"camName `{cam_name}`, removing cols starting with `{start}`")
+    pose.drop(~np.char.startswith(pose.bodyparts, start))
+
+
+@register_step("replace_likelihood")
+def replace_likelihood_step(pose: PoseFrame, cam_name: str, value: float = 1.0) -> None:
+    """Replace all `likelihood` values in the working buffer with `value`, see `replace_likelihood`"""
+    pose.values[:, :, 2] = value
+
+
+def run_chain(pose: PoseFrame, cam_name: str, steps: list, options: dict = None) -> PoseFrame:
+    """Run registered cleaning steps in order on the working buffer
+
+    Parameters
+    ----------
+    pose : PoseFrame
+        Working buffer, changed in place
+    cam_name : str
+        Camera letter name
+    steps : list
+        Names of the registered steps, run in the order given
+    options : dict, optional
+        Step name -> keyword arguments for that step
 
     Returns
     -------
+    PoseFrame
+        The same working buffer
+    """
+    options = options or {}
+    for name in steps:
+        try:
+            step = CLEANING_STEPS[name]
+        except KeyError:
+            raise ValueError(
+                f"Unknown cleaning step `{name}`, registered steps: {list(CLEANING_STEPS)}"
+            )
+        logging.info(f"Running `{name}` preprocessing...")
+        step(pose, cam_name, **dict(options.get(name, {})))
+    return pose
+
+
+def clean_frame(
+    df: pd.DataFrame,
+    col_names: list = (),
+    n: int = 1,
+    start: str = "",
+    likelihood: float = None,
+) -> pd.DataFrame:
+    """Run fix points, remove cols and replace likelihood as batched array operations.
+
+    The x/y/likelihood block is extracted once, all steps run on the array and the
+    multi-indexed dataframe is only built once at the end.
+
+    Parameters
+    ----------
     df : pd.DataFrame
-        Full dataframe (representing DLC CSV) with specified points fixed
+        Panda DataFrame representing DLC CSV data
+    col_names : list, optional
+        Names of the bodyparts which will have their points fixed, by default none
+    n : int, optional
+        Replace fixed values with nth entry. To replace with the mean of whole column, choose 0, by default 1
+    start : str, optional
+        Remove bodyparts whose name starts with given string, by default nothing is removed
+    likelihood : float, optional
+        Replace all `likelihood` values with this value, by default the likelihood is kept
+
+    Returns
+    -------
+    pd.DataFrame
+        Full dataframe (representing DLC CSV) with all cleaning steps applied
     """
-    new_df = df.copy()
+    steps = ["fix_point", "remove_cols"]
+    options = {
+        "fix_point": {"bodyparts": col_names, "n": n},
+        "remove_cols": {"start": start},
+    }
+    if likelihood is not None:
+        steps.append("replace_likelihood")
+        options["replace_likelihood"] = {"value": likelihood}
 
-    for bodypart in col_names:
-        for scorer in df.columns.levels[0]:
-            x_tuple = (scorer, bodypart, 'x')
-            y_tuple = (scorer, bodypart, 'y')
+    pose = run_chain(PoseFrame.from_df(df), "", steps, options)
+    return pose.to_df()
 
-            if x_tuple in df.columns and y_tuple in df.columns:
-                # Select 'x' and 'y' columns for the bodypart
-                x_col = df[x_tuple]
-                y_col = df[y_tuple]
 
-                # masks for non-missing values
-                x_mask = x_col.notna()
-                y_mask = y_col.notna()
+def _run_step(df: pd.DataFrame, name: str, **options) -> pd.DataFrame:
+    # one registered step on a copy of `df`
+    return run_chain(PoseFrame.from_df(df), "", [name], {name: options}).to_df()
 
-                # Calculate replacement values
-                if n > 0 and len(x_col[x_mask]) >= n and len(y_col[y_mask]) >= n:
-                    # Select value at nth position (n-1th index)
-                    x_replace_value = x_col[x_mask].iloc[n-1]
-                    y_replace_value = y_col[y_mask].iloc[n-1]
-                else:
-                    x_replace_value = x_col[x_mask].mean()
-                    y_replace_value = y_col[y_mask].mean()
 
-                # Update the 'x' and 'y' columns in new_df for non-missing values
-                new_df.loc[x_mask, x_tuple] = x_replace_value
-                new_df.loc[y_mask, y_tuple] = y_replace_value
+def replace_likelihood(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Replace `likelihood` column values with 1.0
+    """
+    return _run_step(df, "replace_likelihood", value=1.0)
+
+
+#! Note: fix point only on x,y not x2,y2,...xn,yn; can be changed if necessary to have x2..xn and y2..yn
+def fix_point(df: pd.DataFrame, col_names: list, n: int = 1) -> pd.DataFrame:
+    """Replace all values in a DataFrame corresponding to DLC CSV data with one value.
+    This is useful for a point that should stay fixed. Missing values are conserved.
+
+    Parameters
+    ----------
+    df: DataFrame
+        Panda DataFrame representing CSV data
+    col_names : list
+        Names of the bodyparts
+    n : int, optional
+        Replace values with nth entry. To replace with the mean of whole column, choose 0, by default 1
+
+    Returns
+    -------
+    df : pd.DataFrame
+        Full dataframe (representing DLC CSV) with specified points fixed
+    """
+    return _run_step(df, "fix_point", bodyparts=col_names, n=n)
 
-    return new_df
 
 def remove_cols(df: pd.DataFrame, start) -> pd.DataFrame:
     """Remove columns in a DEEPLABCUT CSV based on second rows (bodyparts).
@@ -79,20 +309,13 @@ def remove_cols(df: pd.DataFrame, start) -> pd.DataFrame:
     Parameters
     ----------
     df : pd.DataFrame
-        Panda DataFrame representing CSV data 
+        Panda DataFrame representing CSV data
     start : str
-        Remove column if name starts with given string 
+        Remove column if name starts with given string
 
     Returns
     -------
     DataFrame
         Full dataframe (representing DLC CSV) with columns removed
     """
-
-    # filter columns based on beginning of name
-    filter =[col for col in df if col[1].startswith(start)] # Select all cols that have 'bodyparts' column start with `start`
-    new_df = df.copy()
-    new_df.drop(columns=filter, inplace=True)
-
-    return new_df
-
+    return _run_step(df, "remove_cols", start=start)
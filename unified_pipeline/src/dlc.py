@@ -3,9 +3,22 @@ Run the DLC API on raw videos to analyze videos and generate tracking points
 """
 
 import logging
+import multiprocessing
+import queue
+import shutil
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from pathlib import Path
-import deeplabcut
 import src.file_tools as file_tools
+import src.fs_index as fs_index
+from src.ledger import JobLedger, snapshot_outputs
+from src.scheduler import Job, run_jobs
+from src.shard import finish_shards, is_shard, prepare_shards, shard_jobs
+from src.staging import StagingCache
+from src.video import VIDEO_INDEX, check_frame_counts
 
 # from pipeline.config import VIDEOS_PATH
 from src.file_tools import load_config
@@ -13,212 +26,595 @@ from src.file_tools import load_config
 from config import settings
 
 VIDEOS_PATH = Path(settings.videos_path)
+# check that all cameras of a fly have the same frame count before analyzing: off, warn or skip (the fly)
+CHECK_FRAME_COUNTS: str = settings.get("check_frame_counts", "warn")
+# DLC always writes h5 files, the CSVs are only needed if they are examined by hand
+DLC_SAVE_AS_CSV: bool = settings.get("dlc_save_as_csv", True)
+# if true, DLC is called once for all videos that use the same model instead of once per video
+DLC_BATCH_INFERENCE: bool = settings.get("dlc_batch_inference", True)
+# number of worker processes for DLC, 1 runs everything in this process
+DLC_WORKERS: int = settings.get("dlc_workers", 1)
+# seconds of inference per second of video, used for time estimates, 0 if unknown
+DLC_REALTIME_FACTOR: float = settings.get("dlc_realtime_factor", 0)
+# SQLite file with the finished DLC jobs, empty to only check for existing outputs
+DLC_LEDGER: str = settings.get("dlc_ledger", "")
+# pipelined mode: processes filtering the predictions, analyzed batches waiting for them and videos per batch
+DLC_FILTER_WORKERS: int = settings.get("dlc_filter_workers", 2)
+DLC_QUEUE_SIZE: int = settings.get("dlc_queue_size", 4)
+DLC_PIPELINE_CHUNK: int = settings.get("dlc_pipeline_chunk", 8)
+# videos with more frames are split into shards of this many frames and analyzed in parallel, 0 to disable
+DLC_SHARD_FRAMES: int = settings.get("dlc_shard_frames", 0)
+DLC_SHARD_DIR: str = settings.get("dlc_shard_dir", "")
+# local folder that videos and models are copied to before inference, empty to read them from the share
+STAGING_DIR: str = settings.get("staging_dir", "")
+STAGING_MAX_BYTES: int = int(settings.get("staging_max_gb", 0) * 1e9)
+
+def _deeplabcut():
+    # imported on first use, so listing the pending videos does not load Tensorflow/PyTorch
+    import deeplabcut
+
+    return deeplabcut
+
+
+## note: add more categories here if new networks for new contexts are added; eg: amputated, decap etc.
+CONTEXTS = ["Ball", "SS"]
+
+
+# Resolved DLC network: `model_name` and `filtered_suffix` are None if the model name could not be determined
+ModelInfo = namedtuple(
+    "ModelInfo", ["path", "config_path", "config", "iteration", "model_name", "filtered_suffix"]
+)
+
+
+class ModelRegistry:
+    """Resolves the metadata of each DLC network once per run
+
+    The config.yaml and the evaluation results of a network are only read the first time the network is used,
+    the same registry can be shared by all contexts and later stages.
+    """
 
-
-# DLC Generation
-def analyze_new(
-    videos_folders_path: Path = VIDEOS_PATH,
-    network_sets_path: Path = Path("../common_files/DLC_network_sets.yml"),
-) -> None:
-    """Run appropriate model with DLC on each video
+    def __init__(self):
+        self._models = {}
+
+    def get(self, model_path):
+        """Get the metadata of a DLC network
+
+        Parameters
+        ----------
+        model_path : str or Path
+            Path to the DLC network folder (containing config.yaml)
+
+        Returns
+        -------
+        ModelInfo or None
+            None if the network has no config.yaml
+        """
+        model_path = Path(model_path)
+        if model_path not in self._models:
+            self._models[model_path] = self._resolve(model_path)
+        return self._models[model_path]
+
+    @staticmethod
+    def _resolve(model_path: Path):
+        config_path = model_path / "config.yaml"
+        if not config_path.is_file():
+            return None
+
+        config = file_tools.load_config(config_path)
+        n_iteration = config["iteration"]
+        csvs = [
+            *(config_path.parent / f"evaluation-results/iteration-{n_iteration}/").glob("*/*-results.csv")
+        ]  # this should only find one CSV file
+        model_name = csvs[0].name.replace("-results.csv", "") if len(csvs) == 1 else None
+        filtered_suffix = f"{model_name}_filtered" if model_name else None
+        logging.info(f"Resolved DLC model {model_path}: iteration {n_iteration}, model name {model_name}")
+
+        return ModelInfo(model_path, config_path, config, n_iteration, model_name, filtered_suffix)
+
+    def __len__(self):
+        return len(self._models)
+
+
+def find_pending_videos(
+    videos_folders_path: Path,
+    network_sets: dict,
+    registry: ModelRegistry = None,
+    ledger: JobLedger = None,
+) -> dict:
+    """Find all videos that still have to be analyzed and group them by the model they use
 
     Parameters
     ----------
     videos_folders_path : Path
         File path to genotype directory with experiment videos
-
-    network_sets_path : Path
-        File path to the config file containing model paths
+    network_sets : dict
+        Context (Ball, SS) -> camera name -> path to the DLC network
+    registry : ModelRegistry, optional
+        Resolved DLC networks, shared with other stages, by default a new registry
+    ledger : JobLedger, optional
+        Finished jobs, checked before looking for the DLC output of a video, by default not used
+
+    Returns
+    -------
+    dict
+        {(context, camera name, path to model config.yaml): [video files]}, the videos of one group can be analyzed
+        with a single DLC call
     """
+    registry = registry if registry is not None else ModelRegistry()
+    groups = {}
+    fs_index.refresh(videos_folders_path)
 
-    network_sets = file_tools.load_config(network_sets_path)
-    model_paths_ball = network_sets["Ball"]
-    model_paths_SS = network_sets[
-        "SS"
-    ]  ## note: add more categories here if new networks for new contexts are added; eg: amputated, decap etc.
-
-    # all folders to analyze (Nx / Ball / Video files)
-    logging.info(f"Searching through {videos_folders_path}")
-
-    ball_video_folders = [
-        *videos_folders_path.glob("**/N*/Ball")
-    ]  ## looks for 'Ball' subfolder insiede N* folders
-    SS_video_folders = [
-        *videos_folders_path.glob("**/N*/SS")
-    ]  ## looks for 'SS' subfolder insiede N* folders
-
-    logging.info(f"Found {len(ball_video_folders)} Ball folders")
-    logging.info(f"Found {len(SS_video_folders)} SS folders")
+    for context in CONTEXTS:
+        model_paths = network_sets[context]
 
-    if len(ball_video_folders) == 0:
-        print("No Ball video folders found, skipping analysis.")
-        logging.warning("No Ball video folders found, skipping analysis.")
+        # all folders to analyze (Nx / <context> / Video files)
+        video_folders = fs_index.rglob(
+            videos_folders_path, f"N*/{context}", dirs=True
+        )  ## looks for context subfolder inside N* folders
+        logging.info(f"Found {len(video_folders)} {context} folders")
 
-    else:
-        # cycle through all video folders
-        for video_folder in ball_video_folders:
-            print()
+        if len(video_folders) == 0:
+            print(f"No {context} video folders found, skipping analysis.")
+            logging.warning(f"No {context} video folders found, skipping analysis.")
+            continue
 
+        for video_folder in video_folders:
             # all mp4 files
-            video_files = [*video_folder.glob("*.mp4")]
-            logging.info(f"Found {len(video_files)} MP4 files")
+            video_files = fs_index.glob(video_folder, "*.mp4")
+            logging.info(f"Found {len(video_files)} MP4 files in {video_folder}")
 
-            # Run DLC on each video file within the current video folder
             for video_file in video_files:
-
-                logging.info(f"Analyzing movie: {video_file.name}")
-
-                # check if camera model is defined in `model_paths_ball``
+                # check if camera model is defined in the network set of this context
                 cam_type = video_file.name.split("-")[
                     0
                 ]  # string before first '-' is camera name
                 try:
-                    p = model_paths_ball[cam_type]
+                    p = model_paths[cam_type]
                     if not p:  # if model is defined but path empty
                         logging.info(
-                            f"Skipping video file: model path empty for Camera {cam_type}"
+                            f"Skipping video file {video_file.name}: model path empty for Camera {cam_type}"
                         )
                         continue
                 except KeyError:  # if model is not defined
                     logging.warning(
-                        f"Skipping video file:  model path not defined for Camera {cam_type}"
+                        f"Skipping video file {video_file.name}: model path not defined for Camera {cam_type}"
                     )
                     continue
 
-                # path to the DLC config for that particular network
-                model_config_path = Path(model_paths_ball[cam_type]) / "config.yaml"
-                if not model_config_path.is_file():
+                # DLC config for that particular network
+                model = registry.get(p)
+                if model is None:
                     logging.warning(
-                        f"Skipping video file: config file does not exist at {model_config_path}"
+                        f"Skipping video file {video_file.name}: config file does not exist at {Path(p) / 'config.yaml'}"
                     )
                     continue
 
-                # determine model name
-                model_config = file_tools.load_config(
-                    model_config_path
-                )  # read dlc cfg to get `iteration`
-                n_iteration = model_config["iteration"]
-                model_folder = (
-                    model_config_path.parent
-                    / f"evaluation-results/iteration-{n_iteration}/"
-                )
-                csvs = [
-                    *model_folder.glob("*/*-results.csv")
-                ]  # this should only find one CSV file
-                if len(csvs) != 1:
+                if ledger is not None and ledger.is_done(video_file, model):
+                    logging.info(
+                        f"Skipping video file {video_file.name}: already analyzed according to the job ledger"
+                    )
+                    continue
+
+                if model.model_name is None:
                     logging.warning("Could not determine model name, skipping check ")
                 else:
-                    # get model name from CSV name
-                    model_csv = csvs[0]
-                    model_name = model_csv.name.replace("-results.csv", "")
-
                     # check if video already has been analyzed with given model
-                    output = (
-                        video_file.parent
-                        / f"{video_file.stem}{model_name}_filtered.csv"
-                    )
-                    if output.is_file():
+                    output = f"{video_file.stem}{model.filtered_suffix}"
+                    if any(
+                        (video_file.parent / f"{output}{ext}").is_file()
+                        for ext in [".h5", ".csv"]
+                    ):
                         logging.info(
-                            "Skipping video file: *_filtered.cvs file already exists"
+                            f"Skipping video file {video_file.name}: *_filtered.h5 or *_filtered.csv file already exists"
                         )
                         continue
 
-                # additional logging
-                logging.info(f"Camera: {cam_type}")
-                logging.info(f"DLC Config path: {model_config_path}")
-                logging.info(f"Model path: {model_paths_ball[cam_type]}")
-                logging.info(f"Video file path: {video_file}")
-
-                # run DLC
-                deeplabcut.analyze_videos(
-                    model_config_path, str(video_file), save_as_csv=True
-                )
-                deeplabcut.filterpredictions(
-                    model_config_path, str(video_file), save_as_csv=True
+                groups.setdefault((context, cam_type, model.config_path), []).append(
+                    video_file
                 )
 
-    if len(SS_video_folders) == 0:
-        print("No SS video folders found, skipping analysis.")
-        logging.warning("No SS video folders found, skipping analysis.")
-    else:
-        # cycle through all video folders
-        for video_folder in SS_video_folders:
-            print()
+    if CHECK_FRAME_COUNTS != "off":
+        groups = _check_videos(groups, skip=CHECK_FRAME_COUNTS == "skip")
+    return groups
 
-            # all mp4 files
-            video_files = [*video_folder.glob("*.mp4")]
-            logging.info(f"Found {len(video_files)} MP4 files")
 
-            # Run DLC on each video file within the current video folder
-            for video_file in video_files:
+def _check_videos(groups: dict, skip: bool) -> dict:
+    # check all cameras of every fly with pending videos before anything is queued
+    skipped = set()
+    for video_folder in sorted({v.parent for video_files in groups.values() for v in video_files}):
+        problems = check_frame_counts(fs_index.glob(video_folder, "*.mp4"))
+        if not problems:
+            continue
+        message = f"Videos in {video_folder} do not match: {'; '.join(problems)}"
+        if skip:
+            logging.error(message + ", skipping them")
+            skipped.add(video_folder)
+        else:
+            logging.warning(message)
+    VIDEO_INDEX.save()
 
-                logging.info(f"Analyzing movie: {video_file.name}")
+    groups = {key: [v for v in video_files if v.parent not in skipped] for key, video_files in groups.items()}
+    return {key: video_files for key, video_files in groups.items() if video_files}
 
-                # check if camera model is defined in `model_paths_SS``
-                cam_type = video_file.name.split("-")[
-                    0
-                ]  # string before first '-' is camera name
-                try:
-                    p = model_paths_SS[cam_type]
-                    if not p:  # if model is defined but path empty
-                        logging.info(
-                            f"Skipping video file: model path empty for Camera {cam_type}"
-                        )
-                        continue
-                except KeyError:  # if model is not defined
-                    logging.warning(
-                        f"Skipping video file:  model path not defined for Camera {cam_type}"
-                    )
-                    continue
 
-                # path to the DLC config for that particular network
-                model_config_path = Path(model_paths_SS[cam_type]) / "config.yaml"
-                if not model_config_path.is_file():
-                    logging.warning(
-                        f"Skipping video file: config file does not exist at {model_config_path}"
-                    )
-                    continue
+def run_dlc(model_config_path: Path, videos: list, analyzer=None, destfolder: Path = None) -> None:
+    """Analyze and filter videos with one DLC model
 
-                # determine model name
-                model_config = file_tools.load_config(
-                    model_config_path
-                )  # read dlc cfg to get `iteration`
-                n_iteration = model_config["iteration"]
-                model_folder = (
-                    model_config_path.parent
-                    / f"evaluation-results/iteration-{n_iteration}/"
-                )
-                csvs = [
-                    *model_folder.glob("*/*-results.csv")
-                ]  # this should only find one CSV file
-                if len(csvs) != 1:
-                    logging.warning("Could not determine model name, skipping check ")
-                else:
-                    # get model name from CSV name
-                    model_csv = csvs[0]
-                    model_name = model_csv.name.replace("-results.csv", "")
+    Parameters
+    ----------
+    model_config_path : Path
+        Path to the DLC config.yaml of the network
+    videos : list
+        Video file paths
+    analyzer : module, optional
+        Provides `analyze_videos` and `filterpredictions`, by default `deeplabcut`
+    destfolder : Path, optional
+        Folder for the DLC outputs, by default they are written next to the videos
+    """
+    analyzer = analyzer if analyzer is not None else _deeplabcut()
+    videos = [str(v) for v in videos]
+    logging.info(f"Video files: {videos}")
+    options = {"destfolder": str(destfolder)} if destfolder is not None else {}
 
-                    # check if video already has been analyzed with given model
-                    output = (
-                        video_file.parent
-                        / f"{video_file.stem}{model_name}_filtered.csv"
-                    )
-                    if output.is_file():
-                        logging.info(
-                            "Skipping video file: *_filtered.cvs file already exists"
-                        )
-                        continue
+    analyzer.analyze_videos(model_config_path, videos, save_as_csv=DLC_SAVE_AS_CSV, **options)
+    analyzer.filterpredictions(model_config_path, videos, save_as_csv=DLC_SAVE_AS_CSV, **options)
 
-                # additional logging
-                logging.info(f"Camera: {cam_type}")
-                logging.info(f"DLC Config path: {model_config_path}")
-                logging.info(f"Model path: {model_paths_SS[cam_type]}")
-                logging.info(f"Video file path: {video_file}")
 
-                # run DLC
-                deeplabcut.analyze_videos(
-                    model_config_path, str(video_file), save_as_csv=True
-                )
-                deeplabcut.filterpredictions(
-                    model_config_path, str(video_file), save_as_csv=True
-                )
+def run_dlc_jobs(model_config_path: Path, videos: list, analyzer=None) -> None:
+    """`run_dlc` for scheduled jobs: shards (see `src.shard`) are only analyzed, they are filtered once stitched"""
+    shards = [v for v in videos if is_shard(v)]
+    others = [v for v in videos if not is_shard(v)]
+    if others:
+        run_dlc(model_config_path, others, analyzer)
+    if shards:
+        run_analyze(model_config_path, shards, analyzer)
+
+
+def run_staged(staging: StagingCache, model_config_path: Path, videos: list, infer) -> None:
+    """Run DLC on local copies of the model and videos, the outputs are moved next to the original videos
+
+    Parameters
+    ----------
+    staging : StagingCache
+        Local staging cache
+    model_config_path : Path
+        Path to the DLC config.yaml of the network on the share
+    videos : list
+        Video file paths on the share
+    infer : callable
+        Called as `infer(config_path, videos, destfolder=...)`, e.g. `run_dlc`
+    """
+    model_path = Path(model_config_path).parent
+    local_config = staging.stage_model(model_path)
+
+    # videos with the same name are analyzed separately, their outputs would have the same names
+    batches = []
+    for video in videos:
+        batch = next((b for b in batches if all(v.name != video.name for v in b)), None)
+        if batch is None:
+            batches.append([video])
+        else:
+            batch.append(video)
+
+    for batch in batches:
+        local_videos = [staging.stage(v) for v in batch]
+        out_dir = staging.output_dir()
+        infer(local_config, local_videos, destfolder=out_dir)
+
+        moves = []
+        for p_output in out_dir.iterdir():
+            # video with the longest name the output name starts with
+            matches = [v for v in batch if p_output.name.startswith(v.stem)]
+            if not matches:
+                logging.warning(f"Could not match DLC output {p_output.name} to a video, leaving it in {out_dir}")
+                continue
+            video = max(matches, key=lambda v: len(v.stem))
+            moves.append((p_output, video.parent / p_output.name))
+        staging.flush(moves)
+        if not any(out_dir.iterdir()):
+            out_dir.rmdir()
+        staging.release(batch)
+
+
+def run_analyze(model_config_path: Path, videos: list, analyzer=None) -> None:
+    """Analyze videos without filtering the predictions, see `run_dlc`"""
+    analyzer = analyzer if analyzer is not None else _deeplabcut()
+    analyzer.analyze_videos(
+        model_config_path, [str(v) for v in videos], save_as_csv=DLC_SAVE_AS_CSV
+    )
+
+
+def run_filter(model_config_path: Path, videos: list, analyzer=None) -> None:
+    """Filter the predictions of analyzed videos, see `run_dlc`"""
+    analyzer = analyzer if analyzer is not None else _deeplabcut()
+    analyzer.filterpredictions(
+        model_config_path, [str(v) for v in videos], save_as_csv=DLC_SAVE_AS_CSV
+    )
+
+
+def find_filtered_output(video: Path, model: ModelInfo):
+    """Filtered DLC output of a video, the h5 file if present, else the CSV
+
+    Parameters
+    ----------
+    video : Path
+        Path to the video
+    model : ModelInfo
+        Model the video was analyzed with, if its name is unknown any `<stem>DLC*_filtered` output is used
+
+    Returns
+    -------
+    Path or None
+        None if there is no filtered output
+    """
+    video = Path(video)
+    for ext in [".h5", ".csv"]:
+        if model is not None and model.filtered_suffix:
+            candidates = [video.parent / f"{video.stem}{model.filtered_suffix}{ext}"]
+        else:
+            candidates = sorted(video.parent.glob(f"{video.stem}DLC*_filtered{ext}"))
+        for candidate in candidates:
+            if candidate.is_file():
+                return candidate
+    return None
+
+
+# DLC Generation
+def analyze_new(
+    videos_folders_path: Path = VIDEOS_PATH,
+    network_sets_path: Path = Path("../common_files/DLC_network_sets.yml"),
+    batched: bool = DLC_BATCH_INFERENCE,
+    analyzer=None,
+    registry: ModelRegistry = None,
+    workers: int = DLC_WORKERS,
+    ledger: JobLedger = None,
+) -> ModelRegistry:
+    """Run appropriate model with DLC on each video
+
+    Parameters
+    ----------
+    videos_folders_path : Path
+        File path to genotype directory with experiment videos
+
+    network_sets_path : Path
+        File path to the config file containing model paths
+
+    batched : bool, optional
+        If True, DLC is called once with all pending videos of a (context, camera, model), so every model is
+        only loaded once. Otherwise DLC is called once per video
+
+    analyzer : module, optional
+        Provides `analyze_videos` and `filterpredictions` with the DLC signatures, by default `deeplabcut`.
+        Can be replaced by a stand-in, e.g. to count model loads. Must be picklable if `workers` > 1
+
+    registry : ModelRegistry, optional
+        Resolved DLC networks, by default a new registry for this run
+
+    workers : int, optional
+        Number of worker processes. If > 1, the videos are scheduled longest first over the workers and every
+        worker keeps to its models, see `src.scheduler`. Videos longer than `dlc_shard_frames` from the settings
+        are split and their shards are scheduled with the other videos, see `src.shard`. By default 1.
+        With `staging_dir` set in the settings and 1 worker, the videos and models are copied to a local folder
+        ahead of the inference and the outputs are moved to the share afterwards, see `src.staging`
+
+    ledger : JobLedger, optional
+        Finished jobs are skipped and new ones recorded, by default the `dlc_ledger` from the settings if set
+
+    Returns
+    -------
+    ModelRegistry
+        The registry with all networks used in this run, can be passed on to later stages
+    """
+
+    network_sets = file_tools.load_config(network_sets_path)
+    registry = registry if registry is not None else ModelRegistry()
+    if ledger is None and DLC_LEDGER:
+        ledger = JobLedger(DLC_LEDGER)
+
+    logging.info(f"Searching through {videos_folders_path}")
+    groups = find_pending_videos(videos_folders_path, network_sets, registry, ledger)
+    infer = partial(run_dlc, analyzer=analyzer)
+    # the files in the video folders before any job ran, to find the outputs of models with an unknown name
+    pending = [v for video_files in groups.values() for v in video_files]
+    before = snapshot_outputs(pending) if ledger is not None else None
+
+    def record(model_config_path, videos, seconds):
+        if ledger is not None:
+            ledger.record_batch(videos, registry.get(Path(model_config_path).parent), seconds, before)
+
+    if workers > 1:
+        # long videos are split into shards that are scheduled together with the other videos
+        jobs, plans = [], {}  # plans: original video -> ShardPlan
+        try:
+            for (_, _, model_config_path), video_files in groups.items():
+                model = registry.get(Path(model_config_path).parent)
+                for video in video_files:
+                    info = VIDEO_INDEX.get(video)
+                    n_frames, duration = (info.n_frames, info.duration) if info else (0, 0.0)
+
+                    plan = None
+                    if DLC_SHARD_FRAMES > 0:
+                        plan = prepare_shards(video, model, DLC_SHARD_FRAMES, DLC_SHARD_DIR or None, n_frames)
+                    if plan is None:
+                        jobs.append(Job(video, model_config_path, duration))
+                        continue
+                    plans[video] = plan
+                    jobs += shard_jobs(plan, duration)
+
+            VIDEO_INDEX.save()
+            results = run_jobs(jobs, partial(run_dlc_jobs, analyzer=analyzer), workers, DLC_REALTIME_FACTOR)
+        except Exception:
+            for plan in plans.values():
+                shutil.rmtree(plan.tmp_dir, ignore_errors=True)
+            raise
+
+        shard_of = {p_shard: plan.video for plan in plans.values() for p_shard in plan.shards}
+        plan_seconds = {}  # original video -> time spent on its shards
+        for model_config_path, videos, seconds in results:
+            share = seconds / len(videos)
+            for p_shard in [v for v in videos if v in shard_of]:
+                plan_seconds[shard_of[p_shard]] = plan_seconds.get(shard_of[p_shard], 0.0) + share
+            videos = [v for v in videos if v not in shard_of]
+            if videos:
+                record(model_config_path, videos, share * len(videos))
+
+        for video, plan in plans.items():
+            start = time.perf_counter()
+            finish_shards(plan, partial(run_filter, analyzer=analyzer))
+            seconds = plan_seconds.get(video, 0.0) + time.perf_counter() - start
+            record(plan.model.config_path, [video], seconds)
+        return registry
+
+    staging = StagingCache(STAGING_DIR, STAGING_MAX_BYTES) if STAGING_DIR else None
+    items = list(groups.items())
+    if staging is not None and items:
+        (_, _, model_config_path), video_files = items[0]
+        staging.prefetch(video_files, [Path(model_config_path).parent])
+
+    for i, ((context, cam_type, model_config_path), video_files) in enumerate(items):
+        print()
+        # additional logging
+        logging.info(f"Context: {context}, Camera: {cam_type}")
+        logging.info(f"DLC Config path: {model_config_path}")
+        logging.info(f"Analyzing {len(video_files)} movies")
+
+        if staging is not None and i + 1 < len(items):
+            # copy the next videos while this group is analyzed
+            (_, _, next_config_path), next_video_files = items[i + 1]
+            staging.prefetch(next_video_files, [Path(next_config_path).parent])
+
+        batches = [video_files] if batched else [[v] for v in video_files]
+        for j, videos in enumerate(batches):
+            # run DLC
+            start = time.perf_counter()
+            if staging is None:
+                infer(model_config_path, videos)
+            else:
+                run_staged(staging, model_config_path, videos, infer)
+                # the released space is filled with the videos that did not fit before
+                upcoming = [v for batch in batches[j + 1 :] for v in batch]
+                if i + 1 < len(items):
+                    upcoming += items[i + 1][1]
+                staging.prefetch(upcoming)
+            record(model_config_path, videos, time.perf_counter() - start)
+
+        if staging is not None:
+            next_config_path = items[i + 1][0][2] if i + 1 < len(items) else None
+            if next_config_path != model_config_path:
+                staging.release([], [Path(model_config_path).parent])
+            staging.evict()
+
+    if staging is not None:
+        staging.close()
+    return registry
+
+
+def analyze_pipelined(
+    videos_folders_path: Path = VIDEOS_PATH,
+    network_sets_path: Path = Path("../common_files/DLC_network_sets.yml"),
+    on_filtered=None,
+    analyzer=None,
+    registry: ModelRegistry = None,
+    ledger: JobLedger = None,
+    groups: dict = None,
+    filter_workers: int = DLC_FILTER_WORKERS,
+    queue_size: int = DLC_QUEUE_SIZE,
+    chunk_size: int = DLC_PIPELINE_CHUNK,
+) -> ModelRegistry:
+    """Run DLC with inference and filtering as a producer/consumer pipeline
+
+    This process runs the inference batch by batch. Every analyzed batch goes into a bounded queue and is filtered
+    by a pool of worker processes, so the next inference does not wait for the filtering. Once a batch is filtered,
+    `on_filtered` is called with it (in the order the batches were analyzed), e.g. to clean the output right away.
+
+    Parameters
+    ----------
+    videos_folders_path : Path
+        File path to genotype directory with experiment videos
+    network_sets_path : Path
+        File path to the config file containing model paths
+    on_filtered : callable, optional
+        Called as `on_filtered(model, videos)` with the ModelInfo and the videos of each filtered batch, runs in
+        a separate thread of this process
+    analyzer : module, optional
+        Provides `analyze_videos` and `filterpredictions`, by default `deeplabcut`. Must be picklable if it is
+        a stand-in
+    registry : ModelRegistry, optional
+        Resolved DLC networks, by default a new registry for this run
+    ledger : JobLedger, optional
+        Finished jobs are skipped and new ones recorded, by default the `dlc_ledger` from the settings if set
+    groups : dict, optional
+        Videos to analyze as returned by `find_pending_videos`, by default they are searched for
+    filter_workers : int, optional
+        Number of processes filtering the predictions, by default `dlc_filter_workers` from the settings
+    queue_size : int, optional
+        Maximum number of analyzed batches waiting to be filtered, by default `dlc_queue_size` from the settings
+    chunk_size : int, optional
+        Maximum number of videos analyzed together (with one model load), 0 for all videos of a model,
+        by default `dlc_pipeline_chunk` from the settings
+
+    Returns
+    -------
+    ModelRegistry
+        The registry with all networks used in this run
+    """
+    registry = registry if registry is not None else ModelRegistry()
+    if ledger is None and DLC_LEDGER:
+        ledger = JobLedger(DLC_LEDGER)
+    if groups is None:
+        logging.info(f"Searching through {videos_folders_path}")
+        network_sets = file_tools.load_config(network_sets_path)
+        groups = find_pending_videos(videos_folders_path, network_sets, registry, ledger)
+
+    # the files in the video folders before any job ran, to find the outputs of models with an unknown name
+    pending = [v for video_files in groups.values() for v in video_files]
+    before = snapshot_outputs(pending) if ledger is not None else None
+    filter_queue = queue.Queue(maxsize=max(queue_size, 1))
+    errors = []
+
+    def consume():
+        # filtered batches in the order they were analyzed
+        while True:
+            item = filter_queue.get()
+            if item is None:
+                return
+            model_config_path, videos, future, seconds = item
+            try:
+                future.result()
+                model = registry.get(Path(model_config_path).parent)
+                if ledger is not None:
+                    ledger.record_batch(videos, model, seconds, before)
+                if on_filtered is not None:
+                    on_filtered(model, videos)
+            except Exception as e:
+                logging.exception(f"Filtering or processing failed for {videos}")
+                errors.append(e)
+
+    mp_context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=max(filter_workers, 1), mp_context=mp_context) as pool:
+        consumer = threading.Thread(target=consume, name="dlc-filtered")
+        consumer.start()
+        try:
+            for (context, cam_type, model_config_path), video_files in groups.items():
+                logging.info(f"Context: {context}, Camera: {cam_type}, {len(video_files)} movies")
+                size = chunk_size if chunk_size > 0 else len(video_files)
+                for i in range(0, len(video_files), size):
+                    videos = video_files[i : i + size]
+                    logging.info(f"Video files: {[str(v) for v in videos]}")
+
+                    start = time.perf_counter()
+                    (analyzer or _deeplabcut()).analyze_videos(
+                        model_config_path, [str(v) for v in videos], save_as_csv=DLC_SAVE_AS_CSV
+                    )
+                    seconds = time.perf_counter() - start
+
+                    future = pool.submit(run_filter, model_config_path, videos, analyzer)
+                    # blocks while `queue_size` batches are waiting to be filtered
+                    filter_queue.put((model_config_path, videos, future, seconds))
+        finally:
+            filter_queue.put(None)
+            consumer.join()
+
+    if errors:
+        raise errors[0]
+    return registry
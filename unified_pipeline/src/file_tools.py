@@ -4,11 +4,39 @@ Functions dealing with file IO, analyzing file path or directory to extract info
 
 __author__ = "Jacob Ryabinky"
 
+import csv as _csv
+import hashlib
 import logging
+import os
+import shutil
 import yaml
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+import numpy as np
 import pandas as pd
 
+import src.fs_index as fs_index
+
+try:  # optional, much faster for long float tables
+    import pyarrow  # noqa: F401
+
+    CSV_ENGINE = "pyarrow"
+except ImportError:
+    CSV_ENGINE = "c"
+
+try:  # reflinks (copy-on-write clones) are only available on Linux
+    import fcntl
+
+    FICLONE = 0x40049409
+except ImportError:
+    fcntl = None
+
+PLACEMENT_MODES = ["copy", "hardlink", "symlink", "reflink", "auto"]
+# order in which `auto` placement tries the methods, copy always works
+AUTO_PLACEMENT = ["reflink", "hardlink", "copy"]
+# (device of source, device of destination) -> method that worked, used by `auto` placement
+_placement_by_fs = {}
+
 
 def load_config(path: str):
     """Load config yml as dict.
@@ -30,17 +58,326 @@ def load_config(path: str):
     return cfg
 
 
-def load_csv_as_df(csv: Path) -> pd.DataFrame:
+def file_signature(path: Path) -> tuple:
+    """Cheap identity of a file, changes whenever the file is rewritten
+
+    Parameters
+    ----------
+    path : Path
+        Path to the file
+
+    Returns
+    -------
+    tuple
+        (resolved path as string, size in bytes, modification time in ns)
+    """
+    stat = Path(path).stat()
+    return str(Path(path).resolve()), stat.st_size, stat.st_mtime_ns
+
+
+def _sidecar_path(csv: Path, sidecar_dir: Path = None) -> Path:
+    if sidecar_dir:
+        # one flat cache folder, file name derived from the full CSV path
+        digest = hashlib.sha1(str(Path(csv).resolve()).encode()).hexdigest()
+        return Path(sidecar_dir) / f"{digest}.npz"
+    return Path(str(csv) + ".npz")
+
+
+def save_npz(path: Path, columns: pd.MultiIndex, index, values: np.ndarray, key: tuple = ()) -> None:
+    """Store DLC data as arrays in a binary .npz file, written atomically
+
+    Parameters
+    ----------
+    path : Path
+        Path to the .npz file
+    columns : pd.MultiIndex
+        Column index, e.g. with the levels ('scorer', 'bodyparts', 'coords')
+    index : array-like
+        Frame index
+    values : np.ndarray
+        Float array of shape (frames, columns)
+    key : tuple, optional
+        Strings stored along with the data, used to check if the file is still valid
+    """
+    path = Path(path)
+    # one temp file per process, so concurrent writers of the same file do not clobber each other
+    tmp = path.with_name(path.name + f".{os.getpid()}.tmp")
+    path.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        with open(tmp, "wb") as f:
+            np.savez(
+                f,
+                key=np.array([str(i) for i in key], dtype=str),
+                names=np.array(columns.names, dtype=str),
+                header=np.array(
+                    [columns.get_level_values(i) for i in range(columns.nlevels)], dtype=str
+                ),
+                index=np.asarray(index),
+                values=values,
+            )
+        tmp.replace(path)  # never leave a half written file behind
+    finally:
+        tmp.unlink(missing_ok=True)
+
+
+def load_npz(path: Path) -> tuple:
+    """Load DLC data stored with `save_npz`
+
+    Returns
+    -------
+    tuple
+        (key, columns, index, values)
+    """
+    with np.load(path, allow_pickle=False) as data:
+        columns = pd.MultiIndex.from_arrays(list(data["header"]), names=list(data["names"]))
+        return tuple(data["key"]), columns, data["index"], data["values"]
+
+
+def _read_sidecar(csv: Path, sidecar_dir: Path = None):
+    sidecar = _sidecar_path(csv, sidecar_dir)
+    if not sidecar.exists():
+        return None
+    try:
+        key, columns, index, values = load_npz(sidecar)
+    except (OSError, ValueError, KeyError) as e:
+        logging.warning(f"Could not read sidecar {sidecar}: {e}")
+        return None
+    if key != tuple(str(i) for i in file_signature(csv)):
+        logging.debug(f"Sidecar {sidecar} is outdated")
+        return None
+    return columns, index, values
+
+
+def _write_sidecar(
+    csv: Path, columns: pd.MultiIndex, index, values, sidecar_dir: Path = None
+) -> None:
+    sidecar = _sidecar_path(csv, sidecar_dir)
+    try:
+        save_npz(sidecar, columns, index, values, file_signature(csv))
+    except OSError as e:
+        logging.warning(f"Could not write sidecar {sidecar}: {e}")
+
+
+def read_dlc_csv(csv: Path, sidecar: bool = False, sidecar_dir: Path = None) -> tuple:
+    """Read a CSV file written by DLC into arrays.
+
+    The three header rows (scorer, bodyparts, coords) are parsed once and the numeric body is
+    read with the fastest available engine (pyarrow if installed, else the pandas C parser).
+
+    Parameters
+    ----------
+    csv : Path
+        Path to the DLC CSV file
+    sidecar : bool, optional
+        If True, a binary copy of the parsed data is stored next to the CSV (or in `sidecar_dir`) and
+        used on the next read as long as path, size and modification time of the CSV are unchanged, by default False
+    sidecar_dir : Path, optional
+        Folder for the binary copies instead of next to the CSV, e.g. on a fast local disk
+
+    Returns
+    -------
+    columns : pd.MultiIndex
+        Column index with the levels ('scorer', 'bodyparts', 'coords')
+    index : np.ndarray
+        Frame numbers
+    values : np.ndarray
+        Float array of shape (frames, columns)
+    """
+    if sidecar:
+        cached = _read_sidecar(csv, sidecar_dir)
+        if cached is not None:
+            return cached
+
+    with open(csv, "r", newline="") as f:
+        reader = _csv.reader(f)
+        header = [next(reader) for _ in range(3)]
+
+    columns = pd.MultiIndex.from_arrays(
+        [row[1:] for row in header], names=[row[0] for row in header]
+    )
+
+    body = pd.read_csv(
+        csv, header=None, skiprows=3, engine=CSV_ENGINE, dtype=np.float64
+    ).to_numpy()
+    index = body[:, 0].astype(np.int64)
+    values = np.ascontiguousarray(body[:, 1:])
+
+    if sidecar:
+        _write_sidecar(csv, columns, index, values, sidecar_dir)
+
+    return columns, index, values
+
+
+def load_csv_as_df(csv: Path, sidecar: bool = False, sidecar_dir: Path = None) -> pd.DataFrame:
+    """Load a CSV file written by DLC as multi-indexed DF, see `read_dlc_csv`
+
+    Parameters
+    ----------
+    csv : Path
+        Path to the DLC CSV file
+    sidecar : bool, optional
+        Use a binary copy of the parsed data if it is up to date, by default False
+    sidecar_dir : Path, optional
+        Folder for the binary copies instead of next to the CSV
+
+    Returns
+    -------
+    pd.DataFrame
+        DF with columns ('scorer', 'bodyparts', 'coords')
+    """
+    columns, index, values = read_dlc_csv(csv, sidecar, sidecar_dir)
+    return pd.DataFrame(values, index=pd.Index(index), columns=columns, copy=False)
+
+
+def read_dlc_h5(h5: Path) -> tuple:
+    """Read the HDF file written by DLC into arrays, see `read_dlc_csv`"""
+    df = pd.read_hdf(h5)
+    values = np.ascontiguousarray(df.to_numpy(dtype=np.float64))
+    return df.columns, df.index.to_numpy(), values
+
+
+def read_dlc_output(path: Path, sidecar: bool = False, sidecar_dir: Path = None) -> tuple:
+    """Read DLC output, either the HDF (`.h5`) or the CSV file, see `read_dlc_csv`"""
+    if Path(path).suffix == ".h5":
+        return read_dlc_h5(path)
+    return read_dlc_csv(path, sidecar, sidecar_dir)
+
+
+def find_dlc_outputs(path: Path) -> list:
+    """Find all filtered DLC outputs in `path`. If DLC wrote both, the HDF file is used instead of the CSV.
+
+    Parameters
+    ----------
+    path : Path
+        Folder that is searched recursively
+
+    Returns
+    -------
+    list
+        Sorted paths to `*_filtered.h5` files, and `*_filtered.csv` files without matching HDF file
+    """
+    h5s = set(fs_index.rglob(path, "*_filtered.h5"))
+    csvs = {
+        csv for csv in fs_index.rglob(path, "*_filtered.csv") if csv.with_suffix(".h5") not in h5s
+    }
+    return sorted(h5s | csvs)
+
+
+def _reflink(src: Path, dest: Path) -> None:
+    if fcntl is None:
+        raise OSError("reflinks are not supported on this platform")
+    try:
+        with open(src, "rb") as f_src, open(dest, "wb") as f_dest:
+            fcntl.ioctl(f_dest.fileno(), FICLONE, f_src.fileno())
+    except OSError:
+        Path(dest).unlink(missing_ok=True)
+        raise
+
+
+def _place(src: Path, dest: Path, method: str) -> None:
+    if method == "copy":
+        shutil.copy(src, dest)
+    elif method == "hardlink":
+        os.link(src, dest)
+    elif method == "symlink":
+        os.symlink(Path(src).resolve(), dest)
+    elif method == "reflink":
+        _reflink(src, dest)
+    else:
+        raise ValueError(f"Unknown placement `{method}`, choose from {PLACEMENT_MODES}")
+
+
+def _link(src: Path, dest: Path, mode: str):
+    """Try to link `src` to `dest`, returns the method used or None if the file still has to be copied"""
+    if mode == "copy":
+        return None
+    if mode == "auto":
+        key = (os.stat(src).st_dev, os.stat(Path(dest).parent).st_dev)
+        methods = [_placement_by_fs[key]] if key in _placement_by_fs else AUTO_PLACEMENT
+    elif mode in PLACEMENT_MODES:
+        key = None
+        methods = [mode]
+    else:
+        raise ValueError(f"Unknown placement `{mode}`, choose from {PLACEMENT_MODES}")
+
+    for method in methods:
+        if method == "copy":
+            break
+        try:
+            _place(src, dest, method)
+        except OSError as e:
+            logging.debug(f"Could not {method} {src} to {dest}: {e}")
+            continue
+        if key is not None:
+            _placement_by_fs[key] = method
+        return method
+
+    if key is not None:
+        # no link possible between these filesystems, don't try again
+        _placement_by_fs[key] = "copy"
+    return None
+
+
+def place_file(src: Path, dest: Path, mode: str = "copy") -> str:
+    """Place a file at `dest` by copying or linking it.
+
+    Linked files share their data with `src`, so they must be treated as read-only.
+
+    Parameters
+    ----------
+    src : Path
+        Existing file
+    dest : Path
+        New file, must not exist
+    mode : str, optional
+        `copy`, `hardlink`, `symlink`, `reflink` or `auto`. `auto` uses the first of reflink, hardlink and copy that
+        works and remembers it for each pair of filesystems. If a link can not be created, the file is copied,
+        by default "copy"
+
+    Returns
+    -------
+    str
+        The method that was used
+    """
+    method = _link(src, dest, mode)
+    if method is None:
+        shutil.copy(src, dest)
+        method = "copy"
+    return method
+
+
+def place_files(files: list, mode: str = "copy", workers: int = 4) -> None:
+    """Place many files, see `place_file`. Links are created right away, copies run in parallel threads.
+
+    Parameters
+    ----------
+    files : list
+        List of tuples (src, dest)
+    mode : str, optional
+        `copy`, `hardlink`, `symlink`, `reflink` or `auto`, by default "copy"
+    workers : int, optional
+        Number of threads used for copies, by default 4
+    """
+    copies = []
+    for src, dest in files:
+        method = _link(src, dest, mode)
+        if method is None:
+            copies.append((src, dest))
+        else:
+            logging.info(f"Placed file {src} at {dest} ({method})")
 
-    # READS AS MULTI-INDEXEDS == does not work with current data preprocess methods
+    def copy(pair):
+        src, dest = pair
+        logging.info(f"Copying file {src} to {dest}")
+        shutil.copy(src, dest)
 
-    df = pd.read_csv(csv, index_col=0, header=[0, 1, 2])
-    df.columns.set_levels([df.columns[0][0]], level="scorer")
-    return df
+    if len(copies) <= 1 or workers <= 1:
+        for pair in copies:
+            copy(pair)
+        return
 
-    # OLD CODE FOR FLAT READING
-    # df = pd.read_csv(csv, header=None, low_memory=False) # read CSV into pandas dataframe
-    # return df
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(copy, copies))  # list to raise any errors
 
 
 def get_csvs(path: Path) -> list:
@@ -58,7 +395,7 @@ def backup_file(path: Path) -> None:
 
 def find_nx_dirs(parent_dir: Path) -> list:
     dirs = []
-    for n1 in parent_dir.glob("**/N1"):
+    for n1 in fs_index.rglob(parent_dir, "N1", dirs=True):
         parent = n1.parent
         if parent.name != "project":
             dirs.append(parent)
@@ -0,0 +1,255 @@
+"""
+In-memory index of the experiment tree, shared by all pipeline stages
+
+The tree is walked once with `os.scandir` and the names of the subdirectories and files of every directory are kept
+together with the directory mtime. A directory's mtime changes whenever an entry is added, removed or renamed,
+so `refresh` only lists the directories whose mtime changed. With a snapshot folder set, the index is saved to disk
+by `save` (at the end of a stage and when the process exits) and a new process (e.g. step 2) starts from the
+snapshot instead of walking the whole share again.
+
+Use `rglob` and `glob` like `Path.glob("**/<pattern>")` and `Path.glob(<pattern>)`. The index is built on first
+use; stages call `refresh` once at their start to pick up the files written by earlier stages.
+"""
+
+import atexit
+import fnmatch
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+
+from config import settings
+
+USE_FS_INDEX: bool = settings.get("fs_index", True)
+FS_INDEX_SNAPSHOT_DIR: str = settings.get("fs_index_snapshot_dir", "")
+
+# one index per scanned root
+_indexes = []
+
+
+def _key(path) -> str:
+    return os.path.normcase(os.path.abspath(path))
+
+
+def _is_under(key: str, top: str) -> bool:
+    return key == top or key.startswith(top.rstrip(os.sep) + os.sep)
+
+
+class FsIndex:
+    """Names of all subdirectories and files below `root`
+
+    Parameters
+    ----------
+    root : Path
+        Top directory of the index
+    snapshot_dir : str or Path, optional
+        Folder to save the index in and load it from, by default no snapshot is used
+    """
+
+    def __init__(self, root: Path, snapshot_dir=None):
+        self.root = Path(os.path.abspath(root))
+        self.snapshot_path = None
+        if snapshot_dir:
+            digest = hashlib.sha1(_key(self.root).encode()).hexdigest()
+            self.snapshot_path = Path(snapshot_dir) / f"fs_index_{digest}.json"
+        # normalized path -> [path, mtime_ns, subdirectory names, file names]
+        self._dirs = self._load_snapshot()
+        self._dirty = False  # changed since the snapshot was loaded or saved
+        self.refresh()
+
+    def _load_snapshot(self) -> dict:
+        if self.snapshot_path is None or not self.snapshot_path.is_file():
+            return {}
+        try:
+            with open(self.snapshot_path) as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            logging.warning(f"Could not read the file index snapshot {self.snapshot_path}: {e}")
+            return {}
+
+    def save(self) -> None:
+        """Write the snapshot if the index changed since it was loaded or saved"""
+        if self.snapshot_path is None or not self._dirty:
+            return
+        self.snapshot_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.snapshot_path.with_suffix(".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(self._dirs, f)
+        os.replace(tmp_path, self.snapshot_path)
+        self._dirty = False
+
+    def contains(self, path) -> bool:
+        return _is_under(_key(path), _key(self.root))
+
+    def refresh(self, path=None) -> None:
+        """Update the index below `path`, only directories with a changed mtime are listed again
+
+        Parameters
+        ----------
+        path : Path, optional
+            Directory inside the root, by default the whole index is updated
+        """
+        top = _key(path if path is not None else self.root)
+        previous = {k: v for k, v in self._dirs.items() if _is_under(k, top)}
+        for k in previous:
+            del self._dirs[k]
+
+        n_listed = 0
+        stack = [os.path.abspath(path if path is not None else self.root)]
+        while stack:
+            dir_path = stack.pop()
+            key = _key(dir_path)
+            try:
+                mtime = os.stat(dir_path).st_mtime_ns
+            except OSError:
+                continue
+
+            entry = previous.get(key)
+            if entry is None or entry[1] != mtime:
+                subdirs, files = [], []
+                try:
+                    with os.scandir(dir_path) as it:
+                        for e in it:
+                            try:
+                                is_dir = e.is_dir(follow_symlinks=False)
+                            except OSError:
+                                continue
+                            (subdirs if is_dir else files).append(e.name)
+                except OSError as e:
+                    logging.warning(f"Could not list {dir_path}: {e}")
+                    continue
+                entry = [dir_path, mtime, sorted(subdirs), sorted(files)]
+                n_listed += 1
+
+            self._dirs[key] = entry
+            stack += [os.path.join(dir_path, name) for name in reversed(entry[2])]
+
+        logging.debug(f"Indexed {top}: listed {n_listed} new or changed directories")
+        if n_listed or any(k not in self._dirs for k in previous):
+            self._dirty = True
+
+    def iter_dirs(self, path):
+        """Yield (directory path, subdirectory names, file names) for `path` and all directories below it"""
+        top = _key(path)
+        for key, (dir_path, _, subdirs, files) in self._dirs.items():
+            if _is_under(key, top):
+                yield dir_path, subdirs, files
+
+    def listdir(self, path):
+        """(subdirectory names, file names) of a directory, None if it is not in the index"""
+        entry = self._dirs.get(_key(path))
+        return None if entry is None else (entry[2], entry[3])
+
+
+def get_index(path, snapshot_dir=FS_INDEX_SNAPSHOT_DIR) -> FsIndex:
+    """Index containing `path`, a new one rooted at `path` is built if there is none
+
+    Parameters
+    ----------
+    path : Path
+        Directory that must be inside the index
+    snapshot_dir : str or Path, optional
+        See `FsIndex`, by default `fs_index_snapshot_dir` from the settings
+
+    Returns
+    -------
+    FsIndex
+    """
+    for index in _indexes:
+        if index.contains(path):
+            return index
+    index = FsIndex(path, snapshot_dir)
+    _indexes.append(index)
+    return index
+
+
+def refresh(path) -> None:
+    """Pick up changes below `path` made since the index was built, e.g. at the start of a stage"""
+    if not USE_FS_INDEX:
+        return
+    for index in _indexes:
+        if index.contains(path):
+            index.refresh(path)
+            return
+    get_index(path)
+
+
+def save() -> None:
+    """Write the snapshots of all changed indexes, called at the end of a stage and when the process exits"""
+    for index in _indexes:
+        index.save()
+
+
+atexit.register(save)
+
+
+def _match(path: Path, pattern: str) -> bool:
+    # match the last len(pattern parts) parts of the path, like the parts of a glob pattern
+    parts = pattern.split("/")
+    if len(path.parts) < len(parts):
+        return False
+    return all(fnmatch.fnmatch(name, p) for name, p in zip(path.parts[-len(parts) :], parts))
+
+
+def rglob(path, pattern: str, dirs: bool = False) -> list:
+    """Like `sorted(Path(path).glob("**/" + pattern))` but answered from the index
+
+    Parameters
+    ----------
+    path : Path
+        Directory to search
+    pattern : str
+        Glob pattern of the names, can contain `/` for parent directories, e.g. `N*/Ball`
+    dirs : bool, optional
+        Find directories instead of files, by default False
+
+    Returns
+    -------
+    list
+        Sorted paths, relative to `path` as `Path.glob` would give them
+    """
+    path = Path(path)
+    if not USE_FS_INDEX:
+        return sorted(p for p in path.glob(f"**/{pattern}") if p.is_dir() == dirs)
+
+    index = get_index(path)
+    top = os.path.abspath(path)
+    last = pattern.split("/")[-1]
+    found = []
+    for dir_path, subdirs, files in index.iter_dirs(path):
+        for name in subdirs if dirs else files:
+            if not fnmatch.fnmatch(name, last):
+                continue
+            result = path / os.path.relpath(os.path.join(dir_path, name), top)
+            if _match(result.relative_to(path) if "/" in pattern else Path(name), pattern):
+                found.append(result)
+    return sorted(found)
+
+
+def glob(path, pattern: str, dirs: bool = False) -> list:
+    """Like `sorted(Path(path).glob(pattern))` without recursion, answered from the index
+
+    Parameters
+    ----------
+    path : Path
+        Directory to search
+    pattern : str
+        Glob pattern of the names
+    dirs : bool, optional
+        Find directories instead of files, by default False
+
+    Returns
+    -------
+    list
+        Sorted paths
+    """
+    path = Path(path)
+    if not USE_FS_INDEX:
+        return sorted(p for p in path.glob(pattern) if p.is_dir() == dirs)
+
+    listing = get_index(path).listdir(path)
+    if listing is None:
+        return []
+    subdirs, files = listing
+    return [path / name for name in (subdirs if dirs else files) if fnmatch.fnmatch(name, pattern)]
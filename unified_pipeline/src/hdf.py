@@ -3,9 +3,14 @@ Handle writing from DF to HDF
 """
 
 import logging
+import time
 from pathlib import Path
+import numpy as np
 import pandas as pd
 
+# Anipose reads the pose data from this key
+HDF_KEY = "df_with_missing"
+
 
 def create_file_name(path: Path, root: Path) -> Path:
     """Create appropriate filename from a path for each data file in the format GenotypeFlynum-camName, e.g: for camA in the BPN dataset, for fly N0, filename: BPNN1-A
@@ -45,7 +50,55 @@ def create_file_name(path: Path, root: Path) -> Path:
     return Path(file_name)
 
 
-def df2hdf(df: pd.DataFrame, csv_path: Path, write_path: Path, root: Path) -> None:
+def write_hdf(
+    df: pd.DataFrame,
+    hdf_path: Path,
+    format: str = "fixed",
+    complib: str = None,
+    complevel: int = 0,
+    float32: bool = False,
+) -> float:
+    """Write DF to an HDF file that Anipose can read (key `df_with_missing`)
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        DF representing DLC data
+    hdf_path : Path
+        Path of the HDF file, overwritten if it exists
+    format : str, optional
+        HDF format, `fixed` (fast) or `table`, by default "fixed"
+    complib : str, optional
+        Compression library, e.g. `blosc`, `blosc:lz4` or `zlib`, by default no compression
+    complevel : int, optional
+        Compression level 0-9, 0 disables compression, by default 0
+    float32 : bool, optional
+        Down-cast the values (coordinates and likelihood) to float32, halves the file size, by default False
+
+    Returns
+    -------
+    float
+        Write throughput in MB/s (size of the data in memory over the write time)
+    """
+    if float32:
+        df = df.astype(np.float32)
+    if not complib:
+        complib, complevel = None, 0
+
+    start = time.perf_counter()
+    df.to_hdf(
+        hdf_path, key=HDF_KEY, mode="w", format=format, complib=complib, complevel=complevel
+    )
+    elapsed = time.perf_counter() - start
+
+    throughput = df.memory_usage(index=True).sum() / 1e6 / max(elapsed, 1e-9)
+    logging.debug(f"Wrote {hdf_path} in {elapsed:.3f} s ({throughput:.1f} MB/s)")
+    return throughput
+
+
+def df2hdf(
+    df: pd.DataFrame, csv_path: Path, write_path: Path, root: Path, **hdf_options
+) -> None:
     """Convert pandas DF provided to hdf format and save with proper name format
 
     Parameters
@@ -58,6 +111,8 @@ def df2hdf(df: pd.DataFrame, csv_path: Path, write_path: Path, root: Path) -> No
         Path to which HDF will be written
     root : Path
         Root directory
+    hdf_options
+        Format, compression and float32 options, see `write_hdf`
     """
     # Create new file name
     try:
@@ -75,4 +130,4 @@ def df2hdf(df: pd.DataFrame, csv_path: Path, write_path: Path, root: Path) -> No
     # save to disk
     hdf_path = write_path / hdf_name
     logging.info(f"Writing to file {hdf_path}")
-    df.to_hdf(hdf_path, key="df_with_missing", mode="w")
+    write_hdf(df, hdf_path, **hdf_options)
@@ -0,0 +1,204 @@
+"""
+Local SQLite ledger of finished DLC jobs
+
+A job is one video analyzed with one model. It is identified by the video (path, size, modification time) and
+the model (network path, iteration), so a job is run again if the video is replaced or the model is retrained.
+If the model name is unknown, the outputs of a job are the `<stem>DLC*` files that were written while it ran (see
+`snapshot_outputs`), so videos of such models are not analyzed again either.
+The ledger is only written by the main process (one thread at a time).
+"""
+
+import os
+
+import json
+import logging
+import sqlite3
+import time
+from pathlib import Path
+
+from src.file_tools import file_signature
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    video TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    model TEXT NOT NULL,
+    iteration INTEGER NOT NULL,
+    outputs TEXT NOT NULL,
+    seconds REAL,
+    finished REAL NOT NULL,
+    PRIMARY KEY (video, size, mtime_ns, model, iteration)
+)
+"""
+
+
+def snapshot_outputs(videos: list) -> dict:
+    """Names and mtimes of the files in the folders of the videos, taken before a job to find its outputs later
+
+    Parameters
+    ----------
+    videos : list
+        Paths to the videos
+
+    Returns
+    -------
+    dict
+        {folder: {file name: mtime_ns}}
+    """
+    snapshot = {}
+    for folder in {Path(video).parent for video in videos}:
+        files = {}
+        try:
+            with os.scandir(folder) as it:
+                for e in it:
+                    if e.is_file():
+                        files[e.name] = e.stat().st_mtime_ns
+        except OSError:
+            pass
+        snapshot[folder] = files
+    return snapshot
+
+
+def find_outputs(video: Path, model_name: str = None, before: dict = None) -> list:
+    """Files DLC wrote next to a video with one model (e.g. `<stem><model_name>_filtered.h5`)
+
+    Parameters
+    ----------
+    video : Path
+        Path to the video
+    model_name : str, optional
+        Name of the model, as in `src.dlc.ModelInfo`. If None, the `<stem>DLC*` files that are new or changed
+        since `before` are returned
+    before : dict, optional
+        `snapshot_outputs` taken before the job, required if `model_name` is None
+
+    Returns
+    -------
+    list
+        Sorted paths
+    """
+    video = Path(video)
+    if model_name:
+        return sorted(video.parent.glob(f"{video.stem}{model_name}*"))
+    if before is None:
+        return []
+    previous = before.get(video.parent, {})
+    return sorted(
+        p for p in video.parent.glob(f"{video.stem}DLC*")
+        if p.is_file() and previous.get(p.name) != p.stat().st_mtime_ns
+    )
+
+
+class JobLedger:
+    """Finished DLC jobs in a SQLite database
+
+    Parameters
+    ----------
+    db_path : str or Path
+        SQLite database file, should be on a local disk. Created if it does not exist
+    """
+
+    def __init__(self, db_path):
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        # the pipelined mode records the jobs from its consumer thread
+        self._connection = sqlite3.connect(self.db_path, check_same_thread=False)
+        with self._connection:
+            self._connection.execute(SCHEMA)
+
+    @staticmethod
+    def _key(video: Path, model) -> tuple:
+        return (*file_signature(video), str(model.path), int(model.iteration))
+
+    def is_done(self, video: Path, model) -> bool:
+        """Check if a video was analyzed with a model and all outputs still exist
+
+        Parameters
+        ----------
+        video : Path
+            Path to the video
+        model : ModelInfo
+            Model, see `src.dlc.ModelRegistry`
+
+        Returns
+        -------
+        bool
+        """
+        row = self._connection.execute(
+            "SELECT outputs FROM jobs WHERE video=? AND size=? AND mtime_ns=? AND model=? AND iteration=?",
+            self._key(video, model),
+        ).fetchone()
+        if row is None:
+            return False
+        outputs = json.loads(row[0])
+        return bool(outputs) and all(Path(p).is_file() for p in outputs)
+
+    def record(self, video: Path, model, outputs: list, seconds: float = None) -> None:
+        """Record a finished job, an existing record of the same job is replaced
+
+        Parameters
+        ----------
+        video : Path
+            Path to the video
+        model : ModelInfo
+            Model, see `src.dlc.ModelRegistry`
+        outputs : list
+            Files written by DLC
+        seconds : float, optional
+            Time spent on the video. For videos analyzed together, this is their share of the total time
+        """
+        with self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    *self._key(video, model),
+                    json.dumps([str(p) for p in outputs]),
+                    seconds,
+                    time.time(),
+                ),
+            )
+
+    def record_batch(self, videos: list, model, seconds: float = None, before: dict = None) -> None:
+        """Record videos analyzed together with one model, the outputs are looked up next to each video
+
+        Parameters
+        ----------
+        videos : list
+            Paths to the videos
+        model : ModelInfo
+            Model, see `src.dlc.ModelRegistry`
+        seconds : float, optional
+            Total time spent on all videos
+        before : dict, optional
+            `snapshot_outputs` taken before the videos were analyzed. If the model name is unknown, the files
+            written since then are recorded as the outputs, without it nothing is recorded for such a model
+        """
+        share = seconds / len(videos) if seconds is not None and videos else None
+        for video in videos:
+            outputs = find_outputs(video, model.model_name, before)
+            if not outputs:
+                logging.warning(f"No DLC output found for {video}, not recorded as finished")
+                continue
+            self.record(video, model, outputs, share)
+
+    def pending(self, jobs: list) -> list:
+        """Filter out the finished jobs
+
+        Parameters
+        ----------
+        jobs : list
+            (video, ModelInfo) tuples
+
+        Returns
+        -------
+        list
+            The jobs that still have to be run
+        """
+        return [(video, model) for video, model in jobs if not self.is_done(video, model)]
+
+    def close(self) -> None:
+        self._connection.close()
+
+    def __len__(self):
+        return self._connection.execute("SELECT COUNT(*) FROM jobs").fetchone()[0]
@@ -0,0 +1,165 @@
+"""
+Clean the DLC outputs (see src.clean), one after another or in worker processes
+
+Kept apart from `pipeline_step_1` so the worker processes do not import the DLC and Anipose code.
+"""
+
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import pandas as pd
+
+from config import settings
+from src.cache import ResultCache
+from src.clean import PoseFrame, run_chain
+from src.file_tools import read_dlc_output
+from src.hdf import write_hdf
+
+logger = logging.getLogger(__name__)
+
+SAVE_FINAL_CSV: bool = settings.save_final_csv
+SKIP_PREPROCESSING_FUNCTIONS: bool = settings.skip_preprocessing_functions
+CLEANING: dict = settings.cleaning
+HDF_OPTIONS: dict = dict(settings.get("hdf", {}))
+CSV_SIDECAR: bool = settings.get("csv_sidecar", False)
+CSV_SIDECAR_DIR = Path(settings.csv_sidecar_dir) if settings.get("csv_sidecar_dir") else None
+
+# cleaned DFs are reused on reruns if the DLC output, cleaning settings and code are unchanged
+RESULT_CACHE = (
+    ResultCache(
+        settings.result_cache_dir,
+        max_bytes=int(settings.get("result_cache_max_gb", 0) * 1e9),
+        max_age_days=settings.get("result_cache_max_age_days", 0),
+    )
+    if settings.get("result_cache_dir")
+    else None
+)
+
+
+def clean_dfs(p_csv: Path, keep_original: bool = False):
+    """Run any functions that clean the raw data. The cleaning steps and their options are set in the
+    `cleaning` section of the settings, new steps can be registered in src.clean.
+
+    All steps run in place on one working buffer, so the loaded data is not kept by default.
+
+    Parameters
+    ----------
+    p_csv : Path
+        path to a DLC output file (CSV or h5) that will be processed.
+    keep_original : bool, optional
+        If True, cleaning runs on a copy and the DF as loaded is returned as well, by default False
+
+    Returns
+    -------
+    pd.DataFrame
+        Processed CSV as a DF, or tuple (processed DF, original DF) if `keep_original` is True
+    """
+    logger.info(f"Processing {p_csv.name}")
+
+    use_cache = RESULT_CACHE is not None and not (SKIP_PREPROCESSING_FUNCTIONS or keep_original)
+    if use_cache:
+        cache_key = RESULT_CACHE.key(p_csv, CLEANING)
+        cached_df = RESULT_CACHE.get(cache_key)
+        if cached_df is not None:
+            logger.info(f"Using cached result for {p_csv.name}")
+            return cached_df
+
+    columns, index, values = read_dlc_output(p_csv, CSV_SIDECAR, CSV_SIDECAR_DIR)
+
+    if SKIP_PREPROCESSING_FUNCTIONS or keep_original:
+        csv_df = pd.DataFrame(values, index=index, columns=columns, copy=keep_original)
+
+    if SKIP_PREPROCESSING_FUNCTIONS:
+        # For debugging purposes, if you do not want to rerun these functions each time (to speed up this step), you can just skip over them
+        return (csv_df, csv_df) if keep_original else csv_df
+
+    camName = p_csv.name[0]  # Camera letter name
+    # the array read from the CSV is the working buffer, no copy of the data is made
+    pose = PoseFrame.from_arrays(columns, index, values)
+
+    run_chain(pose, camName, CLEANING["steps"], CLEANING)
+
+    if keep_original:
+        return pose.to_df(), csv_df
+
+    csv_df = pose.to_df()
+    if use_cache:
+        RESULT_CACHE.put(cache_key, csv_df)
+    return csv_df  # without file write
+
+
+def save_final_csv(csv_df: pd.DataFrame, p_csv: Path) -> None:
+    # If config varialbe set, then save the preprocessed data to a CSV for examination
+    preprocessed_name = p_csv.stem + "_preprocessed"  # name of the csv without extension
+    preprocessed_csv_path = p_csv.with_name(preprocessed_name).with_suffix(".csv")
+    logger.info(f"Saving final preprocessed data to {preprocessed_csv_path}")
+    csv_df.to_csv(preprocessed_csv_path)
+
+
+# Module level functions so they can be sent to worker processes
+def clean_csv(p_csv: Path) -> tuple:
+    csv_df = clean_dfs(p_csv)
+    if SAVE_FINAL_CSV:
+        save_final_csv(csv_df, p_csv)
+    return csv_df, p_csv
+
+
+def clean_and_write(p_csv: Path, hdf_path: Path) -> Path:
+    csv_df, _ = clean_csv(p_csv)
+    logger.info(f"Writing to file {hdf_path}")
+    write_hdf(csv_df, hdf_path, **HDF_OPTIONS)
+    return p_csv
+
+
+def parallel_map(func, workers: int, *iterables):
+    """Like `map`, but run in a process pool if more than one worker is requested.
+
+    Parameters
+    ----------
+    func : callable
+        Module level function, called with one item of each iterable
+    workers : int
+        Number of worker processes, 1 runs serially in this process and 0 uses all CPUs
+    iterables
+        Arguments for `func`
+
+    Yields
+    ------
+    Results of `func` in the same order as the arguments
+    """
+    args = list(zip(*iterables))
+    if workers == 0:
+        workers = os.cpu_count()
+
+    if workers == 1 or len(args) <= 1:
+        for arg in args:
+            yield func(*arg)
+        return
+
+    logger.info(f"Running {len(args)} jobs with {workers} worker processes")
+    # fresh processes instead of forks of a parent that may have loaded Tensorflow/PyTorch or hold threads
+    mp_context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=workers, mp_context=mp_context) as pool:
+        # map keeps the input order, so results are the same as for the serial run
+        yield from pool.map(func, *zip(*args))
+
+
+def clean_all(p_csvs: list, workers: int = 1):
+    """Clean all CSVs, either one after another or in a process pool.
+
+    Parameters
+    ----------
+    p_csvs : list
+        Paths to the CSV files that will be processed
+    workers : int, optional
+        Number of worker processes, 1 runs serially in this process and 0 uses all CPUs, by default 1
+
+    Yields
+    ------
+    tuple
+        (processed_df, csv_path) in the same order as `p_csvs`
+    """
+    yield from parallel_map(clean_csv, workers, p_csvs)
@@ -0,0 +1,155 @@
+"""
+Schedule DLC inference jobs (one video with one model) across worker processes
+
+Jobs are grouped by model, so a worker only loads a model once for all of its videos. Models are handed out
+longest first (by total video duration) to the least loaded worker. If there are fewer models than workers, or a
+model has more than an even share of the work (e.g. the shards of a long video, see `src.shard`), the longest groups
+are split so no worker is idle; each split costs one extra model load. Different models (e.g. the
+single camera networks and the shared 3-cam network) run at the same time in different workers.
+"""
+
+import logging
+import multiprocessing
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+# video: video file, config_path: DLC config.yaml of the model, duration: video length in seconds (0 if unknown)
+Job = namedtuple("Job", ["video", "config_path", "duration"], defaults=[0.0])
+
+
+def _total(chunk: list) -> tuple:
+    # total duration, number of videos if the durations are unknown
+    return sum(job.duration for job in chunk), len(chunk)
+
+
+def plan_workers(jobs: list, workers: int) -> list:
+    """Assign the jobs to workers, longest first with model affinity
+
+    Parameters
+    ----------
+    jobs : list
+        List of `Job`
+    workers : int
+        Number of worker processes
+
+    Returns
+    -------
+    list
+        One list per worker with (config_path, [videos]) tuples in the order they are run, workers without
+        any jobs are left out
+    """
+    workers = max(workers, 1)
+
+    # group by model, longest video first
+    groups = {}
+    for job in sorted(jobs, key=lambda j: j.duration, reverse=True):
+        groups.setdefault(job.config_path, []).append(job)
+    chunks = list(groups.values())
+
+    # a group with several even shares of the work is split into that many parts
+    known = any(job.duration for job in jobs)
+    share = (sum(job.duration for job in jobs) if known else len(jobs)) / workers
+    split = []
+    for chunk in chunks:
+        load = _total(chunk)[0] if known else len(chunk)
+        parts = min(len(chunk), workers, max(round(load / share), 1)) if share else 1
+        split += [chunk[i::parts] for i in range(parts)]
+    chunks = split
+
+    # split the longest groups while workers would be idle
+    while chunks and len(chunks) < workers:
+        chunks.sort(key=_total, reverse=True)
+        if len(chunks[0]) < 2:
+            break
+        longest = chunks.pop(0)
+        chunks += [longest[::2], longest[1::2]]
+
+    # longest processing time first: each group goes to the least loaded worker
+    loads = [[(0.0, 0), i, []] for i in range(workers)]
+    for chunk in sorted(chunks, key=_total, reverse=True):
+        worker = min(loads, key=lambda w: (w[0], w[1]))
+        total = _total(chunk)
+        worker[0] = (worker[0][0] + total[0], worker[0][1] + total[1])
+        worker[2].append((chunk[0].config_path, [job.video for job in chunk]))
+
+    # parts of a split group that went to the same worker are run with one model load
+    plan = []
+    for _, _, assignments in loads:
+        merged = {}
+        for config_path, videos in assignments:
+            merged.setdefault(config_path, []).extend(videos)
+        if merged:
+            plan.append(list(merged.items()))
+    return plan
+
+
+def run_worker(assignments: list, infer) -> list:
+    """Run the jobs assigned to one worker
+
+    Parameters
+    ----------
+    assignments : list
+        (config_path, [videos]) tuples, see `plan_workers`
+    infer : callable
+        Called as `infer(config_path, videos)`, must be picklable to run in a worker process
+
+    Returns
+    -------
+    list
+        (config_path, [videos], seconds) for each assignment
+    """
+    results = []
+    for config_path, videos in assignments:
+        start = time.perf_counter()
+        infer(config_path, videos)
+        seconds = time.perf_counter() - start
+        logging.info(f"Analyzed {len(videos)} videos with {config_path} in {seconds:.1f} s")
+        results.append((config_path, videos, seconds))
+    return results
+
+
+def run_jobs(jobs: list, infer, workers: int = 1, realtime_factor: float = 0) -> list:
+    """Run DLC inference jobs in parallel
+
+    Workers are started with `spawn`, so each gets a fresh interpreter (Tensorflow/PyTorch do not work after a fork).
+    On machines with a single GPU the workers share it, on CPU-only machines each worker uses the CPU.
+
+    Parameters
+    ----------
+    jobs : list
+        List of `Job`
+    infer : callable
+        Called as `infer(config_path, videos)`, e.g. `src.dlc.run_dlc` or a stand-in for testing
+    workers : int, optional
+        Number of worker processes, 1 runs in this process, by default 1
+    realtime_factor : float, optional
+        Seconds of inference per second of video, used to log the expected run time, 0 if unknown, by default 0
+
+    Returns
+    -------
+    list
+        (config_path, [videos], seconds) for each group of videos that was analyzed
+    """
+    plan = plan_workers(jobs, workers)
+    durations = {job.video: job.duration for job in jobs}
+    loads = [sum(durations[v] for _, videos in assignments for v in videos) for assignments in plan]
+    message = f"Scheduled {len(jobs)} videos ({sum(loads):.0f} s of video) on {len(plan)} workers"
+    if loads:
+        message += f", longest worker {max(loads):.0f} s of video"
+    if loads and realtime_factor:
+        message += f", expected to take {max(loads) * realtime_factor / 60:.1f} min"
+    logging.info(message)
+
+    if len(plan) <= 1:
+        results = [result for assignments in plan for result in run_worker(assignments, infer)]
+    else:
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=len(plan), mp_context=context) as executor:
+            futures = [executor.submit(run_worker, assignments, infer) for assignments in plan]
+            results = [result for future in futures for result in future.result()]
+
+    if sum(durations.values()):
+        seconds = sum(seconds for _, _, seconds in results)
+        logging.info(f"Inference took {seconds / sum(durations.values()):.2f} s per second of video")
+    return results
@@ -0,0 +1,265 @@
+"""
+Sharded DLC inference for long videos
+
+A long video is split into shards of consecutive frames in one pass (with ffmpeg, see ffmpeg/README.md), the shards
+are analyzed in parallel with `src.scheduler`, together with the other videos of the run, and their unfiltered pose
+tables are stitched back into one table with the frame indices of the original video. The predictions are filtered
+on the whole stitched table, so the filter sees the shard borders like any other frame.
+"""
+
+import logging
+import re
+import shutil
+import subprocess
+import tempfile
+from collections import namedtuple
+from pathlib import Path
+
+import pandas as pd
+
+from src.hdf import HDF_KEY
+from src.scheduler import Job, run_jobs
+from src.video import VIDEO_INDEX
+
+try:  # installed together with DLC
+    import cv2
+except ImportError:
+    cv2 = None
+
+# shards are named <video stem>_shard<index>
+SHARD_PATTERN = re.compile(r"_shard\d{3}$")
+
+# video: original video, model: ModelInfo, tmp_dir: folder with the shards, shards: shard files,
+# ranges: (start, end) frames of the shards, n_frames: frames of the video
+ShardPlan = namedtuple("ShardPlan", ["video", "model", "tmp_dir", "shards", "ranges", "n_frames"])
+
+
+def is_shard(video: Path) -> bool:
+    """Check if a video is a shard written by `split_video`"""
+    return SHARD_PATTERN.search(Path(video).stem) is not None
+
+
+def shard_ranges(n_frames: int, shard_frames: int) -> list:
+    """Split frames 0..n_frames into (start, end) ranges of at most `shard_frames` frames, `end` is exclusive"""
+    return [(start, min(start + shard_frames, n_frames)) for start in range(0, n_frames, shard_frames)]
+
+
+def _split_ffmpeg(video: Path, ranges: list, out_dir: Path) -> list:
+    # one decode and lossless re-encode of the whole video with a keyframe at every shard start, the segment muxer
+    # cuts at these keyframes, so the shard frames are the same as in the video
+    starts = [start for start, _ in ranges]
+    keyframes = "+".join(f"eq(n,{start})" for start in starts)
+    command = [
+        "ffmpeg", "-y", "-v", "error", "-i", str(video),
+        "-an", "-c:v", "libx264", "-qp", "0", "-preset", "ultrafast",
+        "-force_key_frames", f"expr:{keyframes}",
+        "-f", "segment", "-segment_frames", ",".join(str(start) for start in starts[1:]), "-reset_timestamps", "1",
+        str(out_dir / f"{video.stem}_shard%03d{video.suffix}"),
+    ]
+    subprocess.run(command, check=True, capture_output=True)
+    return [out_dir / f"{video.stem}_shard{i:03d}{video.suffix}" for i in range(len(ranges))]
+
+
+def _split_cv2(video: Path, ranges: list, out_dir: Path) -> list:
+    cap = cv2.VideoCapture(str(video))
+    fps = cap.get(cv2.CAP_PROP_FPS)
+    shards = []
+    try:
+        for i, (start, end) in enumerate(ranges):
+            p_shard = out_dir / f"{video.stem}_shard{i:03d}.avi"
+            writer = None
+            for _ in range(start, end):
+                ok, frame = cap.read()
+                if not ok:
+                    break
+                if writer is None:
+                    height, width = frame.shape[:2]
+                    # lossless, so the shard frames are the same as in the video
+                    writer = cv2.VideoWriter(str(p_shard), cv2.VideoWriter_fourcc(*"FFV1"), fps, (width, height))
+                writer.write(frame)
+            if writer is not None:
+                writer.release()
+            shards.append(p_shard)
+    finally:
+        cap.release()
+    return shards
+
+
+def split_video(video: Path, ranges: list, out_dir: Path) -> list:
+    """Write one video per frame range, with ffmpeg if available, else with OpenCV
+
+    Parameters
+    ----------
+    video : Path
+        Path to the video
+    ranges : list
+        (start, end) frame ranges, see `shard_ranges`
+    out_dir : Path
+        Folder for the shards
+
+    Returns
+    -------
+    list
+        Paths to the shards, in the order of `ranges`
+    """
+    out_dir.mkdir(parents=True, exist_ok=True)
+    if shutil.which("ffmpeg"):
+        return _split_ffmpeg(video, ranges, out_dir)
+    if cv2 is None:
+        raise RuntimeError("Splitting videos requires ffmpeg or OpenCV")
+    logging.info("ffmpeg not found, splitting with OpenCV")
+    return _split_cv2(video, ranges, out_dir)
+
+
+def stitch_shards(shard_outputs: list, dest: Path) -> pd.DataFrame:
+    """Concatenate the pose tables of the shards with the frame indices of the original video
+
+    Parameters
+    ----------
+    shard_outputs : list
+        (path to the unfiltered DLC h5 of a shard, first frame of the shard) tuples
+    dest : Path
+        Unfiltered DLC h5 of the original video, written in the format DLC uses
+
+    Returns
+    -------
+    pd.DataFrame
+        The stitched table
+    """
+    dfs = []
+    for p_h5, start in shard_outputs:
+        df = pd.read_hdf(p_h5)
+        df.index = pd.RangeIndex(start, start + len(df))
+        dfs.append(df)
+    df = pd.concat(dfs)
+    if not df.index.is_unique:
+        raise ValueError(f"Overlapping shards for {dest}")
+    df.to_hdf(dest, key=HDF_KEY, format="table", mode="w")
+    return df
+
+
+def prepare_shards(video: Path, model, shard_frames: int, shard_dir: Path = None, n_frames: int = None):
+    """Split a long video into shards that can be analyzed like other videos, e.g. with `src.scheduler.run_jobs`
+
+    Parameters
+    ----------
+    video : Path
+        Path to the video
+    model : ModelInfo
+        Model to use, see `src.dlc.ModelRegistry`, its name must be known to find the outputs
+    shard_frames : int
+        Maximum number of frames per shard
+    shard_dir : Path, optional
+        Folder for the shards (e.g. on a local disk), by default a temporary folder
+    n_frames : int, optional
+        Number of frames of the video if already known, by default it is read from the video
+
+    Returns
+    -------
+    ShardPlan or None
+        None if the video is not sharded (unreadable, short or unknown model name)
+    """
+    video = Path(video)
+    if n_frames is None:
+        info = VIDEO_INDEX.get(video)
+        n_frames = info.n_frames if info is not None else 0
+    if model.model_name is None or n_frames <= shard_frames:
+        return None
+
+    ranges = shard_ranges(n_frames, shard_frames)
+    logging.info(f"Splitting {video.name} into {len(ranges)} shards of up to {shard_frames} frames")
+
+    tmp_dir = Path(tempfile.mkdtemp(prefix=f"{video.stem}_", dir=shard_dir))
+    try:
+        shards = split_video(video, ranges, tmp_dir)
+    except Exception:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+    return ShardPlan(video, model, tmp_dir, shards, ranges, n_frames)
+
+
+def shard_jobs(plan: ShardPlan, duration: float = 0.0) -> list:
+    """`src.scheduler.Job` for every shard, `duration` of the whole video is split by frames"""
+    return [
+        Job(p_shard, plan.model.config_path, duration * (end - start) / plan.n_frames)
+        for p_shard, (start, end) in zip(plan.shards, plan.ranges)
+    ]
+
+
+def finish_shards(plan: ShardPlan, filter_predictions) -> None:
+    """Stitch the analyzed shards into the unfiltered DLC h5 of the video, filter it and remove the shards
+
+    Parameters
+    ----------
+    plan : ShardPlan
+        See `prepare_shards`, all shards must be analyzed
+    filter_predictions : callable
+        Called as `filter_predictions(config_path, videos)` on the original video, e.g. `src.dlc.run_filter`
+    """
+    video, model = plan.video, plan.model
+    try:
+        shard_outputs = []
+        for p_shard, (start, _) in zip(plan.shards, plan.ranges):
+            p_h5 = p_shard.parent / f"{p_shard.stem}{model.model_name}.h5"
+            if not p_h5.is_file():
+                raise FileNotFoundError(f"DLC output of shard {p_shard.name} not found at {p_h5}")
+            shard_outputs.append((p_h5, start))
+
+        df = stitch_shards(shard_outputs, video.parent / f"{video.stem}{model.model_name}.h5")
+        if len(df) != plan.n_frames:
+            logging.warning(f"{video.name}: {plan.n_frames} frames in the header but {len(df)} analyzed")
+    finally:
+        shutil.rmtree(plan.tmp_dir, ignore_errors=True)
+
+    filter_predictions(model.config_path, [video])
+
+
+def analyze_sharded(
+    video: Path,
+    model,
+    analyze,
+    filter_predictions,
+    shard_frames: int,
+    workers: int,
+    shard_dir: Path = None,
+    n_frames: int = None,
+) -> bool:
+    """Analyze a long video as shards in parallel and write the same outputs as DLC for the whole video
+
+    To analyze the shards together with other videos, use `prepare_shards`, `shard_jobs` and `finish_shards`.
+
+    Parameters
+    ----------
+    video : Path
+        Path to the video
+    model : ModelInfo
+        Model to use, see `src.dlc.ModelRegistry`, its name must be known to find the outputs
+    analyze : callable
+        Called as `analyze(config_path, videos)` to write the unfiltered DLC h5 next to each video,
+        must be picklable, e.g. `src.dlc.run_analyze`
+    filter_predictions : callable
+        Called as `filter_predictions(config_path, videos)` on the original video, e.g. `src.dlc.run_filter`
+    shard_frames : int
+        Maximum number of frames per shard
+    workers : int
+        Number of worker processes for the shards
+    shard_dir : Path, optional
+        Folder for the shards (e.g. on a local disk), by default a temporary folder. The shards are removed afterwards
+    n_frames : int, optional
+        Number of frames of the video if already known, by default it is read from the video
+
+    Returns
+    -------
+    bool
+        False if the video was not sharded (unreadable, short or unknown model name), nothing is written then
+    """
+    plan = prepare_shards(video, model, shard_frames, shard_dir, n_frames)
+    if plan is None:
+        return False
+    try:
+        run_jobs(shard_jobs(plan), analyze, workers)
+    except Exception:
+        shutil.rmtree(plan.tmp_dir, ignore_errors=True)
+        raise
+    finish_shards(plan, filter_predictions)
+    return True
@@ -0,0 +1,324 @@
+"""
+Local staging cache for inputs on the network share
+
+Videos, DLC model folders and other inputs (e.g. calibration movies) are copied to a local folder before they are
+used, upcoming ones in background threads as far as the byte budget allows. Every staged file or folder is an entry
+named after the hash of its source path. An entry is reused as long as the size and mtime of the source files are
+unchanged, least recently used entries are evicted once the cache is larger than its byte budget. Outputs can be
+written to a local folder and moved back to the share in bulk with `flush`.
+
+Unlike `src.cache`, entries are not keyed on a digest of their content: hashing a source means reading all of it
+from the share on every lookup, which costs as much as the copy the cache is meant to save. Identical files at
+different paths (e.g. a calibration bundle copied to two folders) are therefore staged twice.
+
+Layout:
+
+    <cache_dir> / entries / <hash of source path> / <name of source file or folder>
+                                                  / used    (mtime = last use)
+                / outputs / <one folder per batch>
+"""
+
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import yaml
+
+from src.file_tools import load_config
+
+
+# trained networks of DLC 2 (Tensorflow) and DLC 3 (PyTorch) projects
+MODEL_DIRS = ["dlc-models", "dlc-models-pytorch"]
+SNAPSHOT_PATTERN = re.compile(r"^snapshot-(?:best-)?(\d+)\.")
+
+
+def _model_files(path: Path):
+    # files DLC needs for inference: the shuffle 1 folder of the config's iteration with only the snapshot
+    # selected by `snapshotindex`, None if there is none. Paths relative to the project folder
+    path = Path(path)
+    config = load_config(path / "config.yaml")
+    iteration = f"iteration-{config.get('iteration', 0)}"
+    fraction = (config.get("TrainingFraction") or [0])[0]
+    shuffle = f"{config.get('Task')}{config.get('date')}-trainset{int(round(fraction * 100))}shuffle1"
+    index = config.get("snapshotindex", -1)
+
+    files = []
+    for models_dir in MODEL_DIRS:
+        p_iteration = path / models_dir / iteration
+        if not p_iteration.is_dir():
+            continue
+        shuffle_dirs = [p_iteration / shuffle] if (p_iteration / shuffle).is_dir() else [p_iteration]
+        for shuffle_dir in shuffle_dirs:
+            snapshots = {}  # snapshot number -> files
+            for dir_path, _, names in os.walk(shuffle_dir):
+                for name in names:
+                    rel = (Path(dir_path) / name).relative_to(path).as_posix()
+                    match = SNAPSHOT_PATTERN.match(name)
+                    if match:
+                        snapshots.setdefault(int(match.group(1)), []).append(rel)
+                    else:
+                        files.append(rel)
+            numbers = sorted(snapshots)
+            if isinstance(index, int) and numbers and -len(numbers) <= index < len(numbers):
+                files += snapshots[numbers[index]]
+            else:
+                files += [rel for number in numbers for rel in snapshots[number]]
+    return files or None
+
+
+def _manifest(path: Path, model: bool = False) -> dict:
+    # relative path -> (size, mtime_ns) of every file in `path`, or of `path` itself
+    # for a DLC model, the files of `_model_files`, None if it has no trained network
+    path = Path(path)
+    if model:
+        files = _model_files(path)
+        if files is None:
+            return None
+        manifest = {"config.yaml": _manifest(path / "config.yaml")["."]}
+        for rel in files:
+            stat = (path / rel).stat()
+            manifest[rel] = [stat.st_size, stat.st_mtime_ns]
+        return manifest
+    if path.is_file():
+        stat = path.stat()
+        return {".": [stat.st_size, stat.st_mtime_ns]}
+    manifest = {}
+    for dir_path, _, files in os.walk(path):
+        for name in files:
+            p = Path(dir_path) / name
+            stat = p.stat()
+            manifest[str(p.relative_to(path).as_posix())] = [stat.st_size, stat.st_mtime_ns]
+    return manifest
+
+
+class StagingCache:
+    """Local copies of files and folders on the network share
+
+    Parameters
+    ----------
+    cache_dir : Path
+        Local folder (e.g. on an SSD) holding the cache, created if needed
+    max_bytes : int, optional
+        Evict least recently used entries once the cache is larger, 0 for no limit, by default 0
+    workers : int, optional
+        Number of threads prefetching files and of threads flushing outputs, by default 2
+    """
+
+    def __init__(self, cache_dir: Path, max_bytes: int = 0, workers: int = 2):
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        (self.cache_dir / "entries").mkdir(parents=True, exist_ok=True)
+        (self.cache_dir / "outputs").mkdir(parents=True, exist_ok=True)
+
+        self._pool = ThreadPoolExecutor(max_workers=max(workers, 1), thread_name_prefix="staging")
+        # outputs are flushed by their own threads, so they do not wait for a prefetch
+        self._flush_pool = ThreadPoolExecutor(max_workers=max(workers, 1), thread_name_prefix="staging-flush")
+        self._lock = threading.Lock()
+        self._pending = {}  # entry dir -> future of a running copy
+        self._in_use = set()  # entries staged and not released yet, not evicted
+        self._prefetched = set()  # entries prefetched but not staged yet
+        self._sizes = {}  # entry dir -> bytes of its source
+
+    def _entry_dir(self, src: Path, model: bool = False) -> Path:
+        key = str(Path(src).resolve()) + ("|model" if model else "")
+        return self.cache_dir / "entries" / hashlib.sha1(key.encode()).hexdigest()[:20]
+
+    def _copy(self, src: Path, entry_dir: Path, manifest: dict, model: bool) -> Path:
+        local = entry_dir / src.name
+        tmp_dir = Path(tempfile.mkdtemp(dir=self.cache_dir / "entries", prefix=".tmp"))
+        try:
+            if model:
+                # DLC only needs the config and the trained network of one snapshot for inference
+                for rel in manifest:
+                    if rel == "config.yaml":
+                        continue
+                    (tmp_dir / src.name / rel).parent.mkdir(parents=True, exist_ok=True)
+                    shutil.copy2(src / rel, tmp_dir / src.name / rel)
+                config = load_config(src / "config.yaml")
+                config["project_path"] = str(local)
+                snapshots = {m.group(1) for m in (SNAPSHOT_PATTERN.match(Path(rel).name) for rel in manifest) if m}
+                if len(snapshots) == 1:
+                    config["snapshotindex"] = -1  # the only snapshot staged
+                with open(tmp_dir / src.name / "config.yaml", "w") as f:
+                    yaml.safe_dump(config, f)
+            elif src.is_dir():
+                shutil.copytree(src, tmp_dir / src.name, copy_function=shutil.copy2)
+            else:
+                shutil.copy2(src, tmp_dir / src.name)
+            (tmp_dir / "manifest.json").write_text(json.dumps(manifest))
+            (tmp_dir / "used").touch()
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            os.replace(tmp_dir, entry_dir)
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+        logging.info(f"Staged {src} at {local}")
+        return local
+
+    def _stage(self, src: Path, model: bool, manifest: dict = None) -> Path:
+        entry_dir = self._entry_dir(src, model)
+        manifest = manifest if manifest is not None else _manifest(src, model)
+        with self._lock:
+            self._sizes[entry_dir] = sum(size for size, _ in manifest.values())
+        p_manifest = entry_dir / "manifest.json"
+        if p_manifest.is_file() and json.loads(p_manifest.read_text()) == manifest:
+            (entry_dir / "used").touch()
+            return entry_dir / src.name
+        return self._copy(src, entry_dir, manifest, model)
+
+    def _submit(self, src: Path, model: bool = False, manifest: dict = None):
+        entry_dir = self._entry_dir(src, model)
+        with self._lock:
+            future = self._pending.get(entry_dir)
+            if future is None or future.done():
+                future = self._pool.submit(self._stage, src, model, manifest)
+                self._pending[entry_dir] = future
+        return future
+
+    def _use(self, src: Path, model: bool = False, manifest: dict = None):
+        # staged entries are kept until they are released
+        entry_dir = self._entry_dir(src, model)
+        future = self._submit(src, model, manifest)
+        with self._lock:
+            self._prefetched.discard(entry_dir)
+            self._in_use.add(entry_dir)
+        return future
+
+    def _reserved_bytes(self) -> int:
+        # bytes of the entries in use and of the prefetched ones
+        return sum(self._sizes.get(d, 0) for d in self._in_use | self._prefetched)
+
+    def prefetch(self, srcs: list, models: list = ()) -> None:
+        """Start staging DLC model folders and files or folders in the background
+
+        Only as many sources are prefetched (in the given order, models first) as fit into `max_bytes` next to
+        the entries in use and the ones prefetched earlier, the others are staged when they are used.
+        """
+        items = [(Path(p), True) for p in models] + [(Path(p), False) for p in srcs]
+        for src, model in items:
+            entry_dir = self._entry_dir(src, model)
+            with self._lock:
+                if entry_dir in self._in_use or entry_dir in self._prefetched:
+                    continue
+            manifest = _manifest(src, model)
+            if manifest is None:
+                continue
+            size = sum(size for size, _ in manifest.values())
+            with self._lock:
+                if self.max_bytes and self._reserved_bytes() + size > self.max_bytes:
+                    logging.debug(f"Staging cache full, not prefetching {src} and the following sources")
+                    return
+                self._sizes[entry_dir] = size
+                self._prefetched.add(entry_dir)
+            self._submit(src, model, manifest)
+
+    def stage(self, src: Path) -> Path:
+        """Local copy of a file or folder, waits for a running prefetch of it
+
+        Parameters
+        ----------
+        src : Path
+            File or folder on the share
+
+        Returns
+        -------
+        Path
+            Path of the local copy, must not be changed
+        """
+        return self._use(Path(src)).result()
+
+    def stage_model(self, model_path: Path) -> Path:
+        """Local copy of a DLC model folder with `project_path` in its config.yaml pointing to the copy
+
+        Only config.yaml and the shuffle 1 folder of the configured iteration in `dlc-models` (or
+        `dlc-models-pytorch`) with the snapshot selected by `snapshotindex` are staged, that is all DLC needs for
+        inference.
+
+        Parameters
+        ----------
+        model_path : Path
+            DLC project folder of the network
+
+        Returns
+        -------
+        Path
+            Path to the config.yaml of the local copy, or of the project on the share if no trained network was found
+        """
+        model_path = Path(model_path)
+        manifest = _manifest(model_path, model=True)
+        if manifest is None:
+            logging.warning(f"No trained network found in {model_path}, using the model on the share")
+            return model_path / "config.yaml"
+        return self._use(model_path, model=True, manifest=manifest).result() / "config.yaml"
+
+    def release(self, srcs: list, models: list = ()) -> None:
+        """Mark staged or prefetched files, folders and model folders as no longer needed by this run, so they can be evicted"""
+        entry_dirs = [self._entry_dir(Path(src)) for src in srcs]
+        entry_dirs += [self._entry_dir(Path(model_path), model=True) for model_path in models]
+        with self._lock:
+            self._in_use.difference_update(entry_dirs)
+            self._prefetched.difference_update(entry_dirs)
+
+    def output_dir(self) -> Path:
+        """New local folder for outputs that are flushed back to the share later"""
+        return Path(tempfile.mkdtemp(dir=self.cache_dir / "outputs"))
+
+    def flush(self, moves: list) -> None:
+        """Move local outputs to the share in bulk, each file appears there only when it is complete
+
+        Parameters
+        ----------
+        moves : list
+            (local file, destination) tuples
+        """
+
+        def move(pair):
+            local, dest = pair
+            tmp = dest.with_name(f".{dest.name}.{os.getpid()}.tmp")
+            shutil.copyfile(local, tmp)
+            os.replace(tmp, dest)
+            Path(local).unlink()
+
+        list(self._flush_pool.map(move, moves))  # list to raise any errors
+        logging.info(f"Flushed {len(moves)} files to the share")
+
+    def evict(self) -> None:
+        """Remove the least recently used entries until the cache fits `max_bytes`, entries in use are kept"""
+        if not self.max_bytes:
+            return
+        with self._lock:
+            # entries in use, prefetched entries and running copies are kept
+            keep = self._in_use | self._prefetched | {d for d, f in self._pending.items() if not f.done()}
+        entries = []
+        for entry_dir in (self.cache_dir / "entries").iterdir():
+            if entry_dir.name.startswith(".") or entry_dir in keep:
+                continue
+            p_used = entry_dir / "used"
+            used = p_used.stat().st_mtime if p_used.exists() else 0
+            size = sum(p.stat().st_size for p in entry_dir.rglob("*") if p.is_file() and not p.is_symlink())
+            entries.append((used, size, entry_dir))
+        entries.sort()  # least recently used first
+
+        total = sum(size for _, size, _ in entries) + sum(
+            p.stat().st_size for d in keep if d.exists() for p in d.rglob("*") if p.is_file() and not p.is_symlink()
+        )
+        removed = 0
+        for _, size, entry_dir in entries:
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            total -= size
+            removed += 1
+        if removed:
+            logging.info(f"Evicted {removed} entries from staging cache {self.cache_dir}")
+
+    def close(self) -> None:
+        self._pool.shutdown(wait=True)
+        self._flush_pool.shutdown(wait=True)
+        self.evict()
@@ -0,0 +1,183 @@
+"""
+Read basic metadata (frame count, frame rate, resolution, duration) of the raw videos without decoding them
+
+The metadata is cached per video path, size and mtime. With `fs_index_snapshot_dir` set, the cache is saved next to
+the file index snapshot, so unchanged videos are only probed once.
+"""
+
+import json
+import logging
+import os
+import subprocess
+from collections import namedtuple
+from pathlib import Path
+
+from src.file_tools import file_signature
+from src.fs_index import FS_INDEX_SNAPSHOT_DIR
+
+try:  # installed together with DLC
+    import cv2
+except ImportError:
+    cv2 = None
+
+
+class VideoInfo(namedtuple("VideoInfo", ["n_frames", "fps", "width", "height"])):
+    """Header metadata of a video, width and height are 0 if unknown"""
+
+    @property
+    def duration(self) -> float:
+        """Duration in seconds"""
+        return self.n_frames / self.fps
+
+
+def _probe_cv2(path: Path):
+    if cv2 is None:
+        return None
+    cap = cv2.VideoCapture(str(path))
+    try:
+        if not cap.isOpened():
+            return None
+        n_frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        fps = cap.get(cv2.CAP_PROP_FPS)
+        width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+        height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    finally:
+        cap.release()
+    if n_frames <= 0 or fps <= 0:
+        return None
+    return VideoInfo(n_frames, fps, width, height)
+
+
+def _probe_ffprobe(path: Path):
+    command = [
+        "ffprobe", "-v", "error", "-select_streams", "v:0",
+        "-show_entries", "stream=nb_frames,r_frame_rate,width,height", "-of", "json", str(path),
+    ]
+    try:
+        process = subprocess.run(command, capture_output=True, text=True, check=True)
+        stream = json.loads(process.stdout)["streams"][0]
+        num, den = stream["r_frame_rate"].split("/")
+        return VideoInfo(
+            int(stream["nb_frames"]), int(num) / int(den), int(stream.get("width", 0)), int(stream.get("height", 0))
+        )
+    except (OSError, subprocess.CalledProcessError, KeyError, IndexError, ValueError, ZeroDivisionError):
+        return None
+
+
+def probe_video(path: Path):
+    """Read the metadata of a video from its header, using ffprobe or OpenCV
+
+    Parameters
+    ----------
+    path : Path
+        Path to the video
+
+    Returns
+    -------
+    VideoInfo or None
+        None if the video could not be read
+    """
+    info = _probe_ffprobe(path) or _probe_cv2(path)
+    if info is None:
+        logging.warning(f"Could not read the frame count of {path}")
+    return info
+
+
+class VideoIndex:
+    """Video metadata cached by path, size and mtime
+
+    Parameters
+    ----------
+    snapshot_dir : str or Path, optional
+        Folder to save the metadata in and load it from, by default it is only kept in memory
+    """
+
+    def __init__(self, snapshot_dir=None):
+        self.path = Path(snapshot_dir) / "video_index.json" if snapshot_dir else None
+        self._infos = {}
+        self._changed = False
+        if self.path is not None and self.path.is_file():
+            try:
+                self._infos = json.loads(self.path.read_text())
+            except ValueError as e:
+                logging.warning(f"Could not read the video index {self.path}: {e}")
+
+    def get(self, path: Path):
+        """Metadata of a video, only probed if the video is new or changed
+
+        Parameters
+        ----------
+        path : Path
+            Path to the video
+
+        Returns
+        -------
+        VideoInfo or None
+            None if the video could not be read
+        """
+        try:
+            key = "|".join(str(i) for i in file_signature(path))
+        except OSError:
+            return None
+        if key not in self._infos:
+            info = probe_video(path)
+            self._infos[key] = list(info) if info is not None else None
+            self._changed = True
+        info = self._infos[key]
+        return VideoInfo(*info) if info is not None else None
+
+    def save(self) -> None:
+        if self.path is None or not self._changed:
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_suffix(".tmp")
+        tmp_path.write_text(json.dumps(self._infos))
+        os.replace(tmp_path, self.path)
+        self._changed = False
+
+
+# shared by all stages of one run
+VIDEO_INDEX = VideoIndex(FS_INDEX_SNAPSHOT_DIR)
+
+
+def video_duration(path: Path) -> float:
+    """Duration of a video in seconds, 0.0 if it could not be read
+
+    Parameters
+    ----------
+    path : Path
+        Path to the video
+
+    Returns
+    -------
+    float
+        Duration in seconds
+    """
+    info = VIDEO_INDEX.get(path)
+    return info.duration if info is not None else 0.0
+
+
+def check_frame_counts(videos: list) -> list:
+    """Check that the videos of all cameras of a fly have the same frame count and frame rate
+
+    Parameters
+    ----------
+    videos : list
+        Videos of one fly and context (e.g. all mp4 files in Nx/Ball)
+
+    Returns
+    -------
+    list
+        Problems found, empty if the videos match
+    """
+    infos = {Path(v).name: VIDEO_INDEX.get(v) for v in videos}
+    problems = [f"{name} could not be read" for name, info in infos.items() if info is None]
+    infos = {name: info for name, info in infos.items() if info is not None}
+
+    if len({info.n_frames for info in infos.values()}) > 1:
+        counts = ", ".join(f"{name}: {info.n_frames}" for name, info in sorted(infos.items()))
+        problems.append(f"frame counts differ ({counts})")
+    if len({round(info.fps, 2) for info in infos.values()}) > 1:
+        rates = ", ".join(f"{name}: {info.fps:.2f}" for name, info in sorted(infos.items()))
+        problems.append(f"frame rates differ ({rates})")
+    return problems